@@ -22,14 +22,38 @@ create table stream_file_events
     lastUpdated      timestamptz,
     lat              float,
     lon              float,
-    receiving_water  text
-);
+    receiving_water  text,
+    file_time        timestamptz not null
+) partition by range (file_time);
+
+-- monthly partitions are created by stream-partitions.py, the default one catches anything before they are
+create table stream_file_events_default partition of stream_file_events default;
 
-create unique index stream_file_events_idx1 on stream_file_events (stream_file_id, id);
+create unique index stream_file_events_idx1 on stream_file_events (stream_file_id, id, file_time);
 
 CREATE INDEX idx_stream_file_events_id_stream_file_id
     ON stream_file_events (id, stream_file_id);
 
+-- each cso's most recent row in stream_file_events, kept by Database.insert_file_events (rebuild with stream-state.py)
+drop table if exists stream_file_events_latest;
+
+create table stream_file_events_latest
+(
+    company          text,
+    id               text,
+    stream_file_id   uuid,
+    file_time        timestamptz,
+    status           text,
+    statusStart      timestamptz,
+    latestEventStart timestamptz,
+    latestEventEnd   timestamptz,
+    lastUpdated      timestamptz,
+    lat              float,
+    lon              float,
+    receiving_water  text,
+    primary key (company, id)
+);
+
 
 drop table if exists stream_file_content cascade;
 
@@ -44,10 +68,24 @@ create table stream_file_content
     lastUpdated      timestamptz,
     lat              float,
     lon              float,
-    receiving_water  text
-);
+    receiving_water  text,
+    file_time        timestamptz not null
+) partition by range (file_time);
+
+create table stream_file_content_default partition of stream_file_content default;
 
-create unique index stream_file_content_idx1 on stream_file_content (stream_file_id, id);
+create unique index stream_file_content_idx1 on stream_file_content (stream_file_id, id, file_time);
+
+-- the last file each cso was in, kept by Database.insert_file_content (rebuild with stream-state.py)
+drop table if exists stream_cso_last_seen;
+
+create table stream_cso_last_seen
+(
+    company        text,
+    id             text,
+    last_seen_time timestamptz,
+    primary key (company, id)
+);
 
 
 drop table if exists stream_files_processed;
@@ -61,6 +99,16 @@ create table stream_files_processed
 
 create unique index stream_files_processed_idx1 on stream_files_processed (company, stream_file_id);
 
+-- every file for the company up to file_time has been processed, kept by Database.mark_processed
+-- (rebuild and check with stream-state.py)
+drop table if exists stream_files_watermark;
+
+create table stream_files_watermark
+(
+    company   text primary key,
+    file_time timestamptz
+);
+
 drop table if exists stream_cso cascade;
 
 create table stream_cso
@@ -89,6 +137,19 @@ create table stream_cso_event
 
 create index stream_cso_event_idx1 on stream_cso_event (stream_cso_id, event_time desc);
 
+-- each cso's most recent event, kept by Database.insert_cso_events (rebuild with stream-state.py)
+drop table if exists stream_cso_latest;
+
+create table stream_cso_latest
+(
+    stream_cso_id uuid primary key,
+    event_time    timestamptz,
+    event         text,
+    file_id       uuid references stream_files (stream_file_id),
+    update_time   timestamptz,
+    file_time     timestamptz
+);
+
 create table stream_summary
 (
     stream_cso_id   uuid,
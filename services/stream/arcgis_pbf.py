@@ -0,0 +1,193 @@
+import struct
+from typing import Iterator, Tuple, Dict, List, Any, Optional
+
+# Just enough of esri's FeatureCollectionPBuffer (f=pbf) to read feature query results,
+# decoded into the same shape as the f=json response so the same converters can be used.
+#
+# FeatureCollectionPBuffer { string version = 1; QueryResult queryResult = 2; }
+# QueryResult { FeatureResult featureResult = 1; ... }
+# FeatureResult { string objectIdFieldName = 1; ... Transform transform = 12;
+#                 repeated Field fields = 13; repeated Feature features = 15; }
+# Field { string name = 1; FieldType fieldType = 2; ... }
+# Feature { repeated Value attributes = 1; Geometry geometry = 2; }
+# Geometry { GeometryType geometryType = 1; repeated uint32 lengths = 2; repeated sint64 coords = 3; }
+# Transform { QuantizeOriginPostion quantizeOriginPostion = 1; Scale scale = 2; Translate translate = 3; }
+
+VARINT = 0
+FIXED64 = 1
+LENGTH = 2
+FIXED32 = 5
+
+FIELD_TYPE_DATE = 5
+UPPER_LEFT = 0
+
+
+class PbfError(Exception):
+    pass
+
+
+def _varint(buf: bytes, pos: int) -> Tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(buf):
+            raise PbfError("Truncated varint")
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _zigzag(n: int) -> int:
+    return (n >> 1) ^ -(n & 1)
+
+
+def _signed(n: int) -> int:
+    # int64 is sent as a 64 bit two's complement varint
+    return n - (1 << 64) if n >= (1 << 63) else n
+
+
+def _fields(buf: bytes) -> Iterator[Tuple[int, int, Any]]:
+    pos = 0
+    while pos < len(buf):
+        key, pos = _varint(buf, pos)
+        number, wire = key >> 3, key & 0x7
+        match wire:
+            case 0:
+                value, pos = _varint(buf, pos)
+            case 1:
+                value, pos = buf[pos:pos + 8], pos + 8
+            case 2:
+                length, pos = _varint(buf, pos)
+                value, pos = buf[pos:pos + length], pos + length
+            case 5:
+                value, pos = buf[pos:pos + 4], pos + 4
+            case _:
+                raise PbfError(f"Unsupported wire type {wire}")
+        yield number, wire, value
+
+
+def _packed(buf: bytes) -> List[int]:
+    values = []
+    pos = 0
+    while pos < len(buf):
+        v, pos = _varint(buf, pos)
+        values.append(v)
+    return values
+
+
+def _value(buf: bytes) -> Any:
+    for number, wire, v in _fields(buf):
+        match number:
+            case 1:
+                return v.decode()
+            case 2:
+                return struct.unpack('<f', v)[0]
+            case 3:
+                return struct.unpack('<d', v)[0]
+            case 4 | 8:
+                return _zigzag(v)
+            case 5 | 7:
+                return v
+            case 6:
+                return _signed(v)
+            case 9:
+                return bool(v)
+    return None
+
+
+def _doubles(buf: bytes) -> Dict[int, float]:
+    return {number: struct.unpack('<d', v)[0] for number, wire, v in _fields(buf) if wire == FIXED64}
+
+
+class Transform:
+    def __init__(self, buf: Optional[bytes]):
+        self.origin = UPPER_LEFT
+        self.scale = {1: 1.0, 2: 1.0}
+        self.translate = {1: 0.0, 2: 0.0}
+        self.quantized = buf is not None
+        for number, wire, v in _fields(buf or b''):
+            match number:
+                case 1:
+                    self.origin = v
+                case 2:
+                    self.scale.update(_doubles(v))
+                case 3:
+                    self.translate.update(_doubles(v))
+
+    def point(self, coords: List[int]) -> Dict[str, float]:
+        x, y = coords[0], coords[1]
+        if not self.quantized:
+            return {'x': float(x), 'y': float(y)}
+        if self.origin == UPPER_LEFT:
+            return {'x': x * self.scale[1] + self.translate[1], 'y': self.translate[2] - y * self.scale[2]}
+        return {'x': x * self.scale[1] + self.translate[1], 'y': y * self.scale[2] + self.translate[2]}
+
+
+def _geometry(buf: bytes, transform: Transform) -> Optional[Dict[str, float]]:
+    coords = []
+    for number, wire, v in _fields(buf):
+        if number == 3:
+            coords = [_zigzag(c) for c in _packed(v)] if wire == LENGTH else [_zigzag(v)]
+    # only points are needed here
+    return transform.point(coords) if len(coords) >= 2 else None
+
+
+def decode_feature_query(buf: bytes) -> Dict:
+    """decodes an f=pbf feature query response into the same shape as the f=json one"""
+    result = None
+    for number, wire, v in _fields(buf):
+        if number == 2:
+            for n, w, qv in _fields(v):
+                if n == 1:
+                    result = qv
+    if result is None:
+        raise PbfError("No featureResult in response")
+
+    object_id_field = None
+    transform_buf = None
+    fields: List[Tuple[str, int]] = []
+    raw_features = []
+
+    for number, wire, v in _fields(result):
+        match number:
+            case 1:
+                object_id_field = v.decode()
+            case 12:
+                transform_buf = v
+            case 13:
+                name, field_type = None, None
+                for n, w, fv in _fields(v):
+                    if n == 1:
+                        name = fv.decode()
+                    elif n == 2:
+                        field_type = fv
+                fields.append((name, field_type))
+            case 15:
+                raw_features.append(v)
+
+    transform = Transform(transform_buf)
+    features = []
+    for raw in raw_features:
+        values = []
+        geometry = None
+        for number, wire, v in _fields(raw):
+            if number == 1:
+                values.append(_value(v))
+            elif number == 2:
+                geometry = _geometry(v, transform)
+        attributes = {}
+        for (name, field_type), value in zip(fields, values):
+            # dates are epoch milliseconds, as in json, but may arrive as a double
+            attributes[name] = int(value) if field_type == FIELD_TYPE_DATE and value is not None else value
+        feature = {'attributes': attributes}
+        if geometry is not None:
+            feature['geometry'] = geometry
+        features.append(feature)
+
+    return {
+        'objectIdFieldName': object_id_field,
+        'features': features
+    }
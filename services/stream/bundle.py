@@ -0,0 +1,65 @@
+import json
+import struct
+from typing import Dict, Optional, Tuple, List
+
+# A day's files for one company packed into one object, so a backfill can fetch a day in one request.
+#
+# 'TOTPBNDL', the length of the index (4 bytes, big endian), the index - json {name: [offset, length]}, offsets
+# from the end of the index - then the files, one after another. The header and index are at the front so they
+# can be read with one small range request, then any one file with another.
+
+MAGIC = b'TOTPBNDL'
+HEADER = struct.Struct('>8sI')
+
+
+class BundleError(Exception):
+    pass
+
+
+def pack(files: Dict[str, bytes]) -> bytes:
+    names = sorted(files)
+    index = {}
+    offset = 0
+    for name in names:
+        index[name] = [offset, len(files[name])]
+        offset += len(files[name])
+    encoded = json.dumps(index).encode()
+    return HEADER.pack(MAGIC, len(encoded)) + encoded + b''.join(files[name] for name in names)
+
+
+def header_length(head: bytes) -> int:
+    """how much of the start of the object is needed to read the index"""
+    if len(head) < HEADER.size:
+        raise BundleError("Truncated bundle header")
+    magic, length = HEADER.unpack_from(head)
+    if magic != MAGIC:
+        raise BundleError("Not a bundle")
+    return HEADER.size + length
+
+
+class BundleIndex:
+    def __init__(self, files: Dict[str, Tuple[int, int]]):
+        self.files = files
+
+    @classmethod
+    def parse(cls, head: bytes) -> 'BundleIndex':
+        """head is at least the first header_length(head) bytes of the object"""
+        end = header_length(head)
+        if len(head) < end:
+            raise BundleError("Truncated bundle index")
+        return cls({name: (end + offset, length) for name, (offset, length) in json.loads(head[HEADER.size:end]).items()})
+
+    def range(self, name: str) -> Optional[Tuple[int, int]]:
+        """first and last byte of the file, as in an http Range"""
+        if name not in self.files:
+            return None
+        offset, length = self.files[name]
+        return offset, offset + length - 1
+
+    def names(self) -> List[str]:
+        return sorted(self.files)
+
+
+def unpack(data: bytes) -> Dict[str, bytes]:
+    index = BundleIndex.parse(data)
+    return {name: data[first:last + 1] for name in index.names() for first, last in [index.range(name)]}
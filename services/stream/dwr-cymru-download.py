@@ -3,12 +3,21 @@ import datetime
 
 from companies import WaterCompany
 from secret import env
-from storage import DwrCymruCSV
+from storage import DwrCymruCSV, DwrCymruParquet, ZstdCodec
 from storage import b2_service, CSVFileStorage, SqlliteStorage, S3Storage
 from stream import DwrCymruAPI
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Download current status from Dwr Cymru non-api")
+    parser.add_argument("--pbf", action="store_true", help="fetch features as protobuf where the service supports it")
+    parser.add_argument("--workers", type=int, default=4, help="concurrent batch requests (default: 4)")
+    parser.add_argument("--parquet", action="store_true", help="also save the snapshot as parquet")
+    parser.add_argument("--delta-storage", action="store_true",
+                        help="save snapshots as changes from a periodic full one")
+    parser.add_argument("--keyframe-hours", type=float, default=24, help="hours between full snapshots (default: 24)")
+    parser.add_argument("--dedupe", action="store_true", help="save an unchanged snapshot as a reference to the last one")
+    parser.add_argument("--zstd", action="store_true", help="save snapshots with zstd, and the company's dictionary")
+    parser.add_argument("--cache-mb", type=int, default=2048, help="local snapshot cache size (default: 2048)")
     args = parser.parse_args()
 
     s3 = b2_service(
@@ -19,12 +28,18 @@ if __name__ == "__main__":
 
     company = WaterCompany.DwrCymru
 
+    cache = SqlliteStorage(delegate=S3Storage(bucket), max_bytes=args.cache_mb * 1024 * 1024)
     storage = CSVFileStorage(
-        SqlliteStorage(delegate=S3Storage(bucket)),
-        DwrCymruCSV()
+        cache,
+        DwrCymruCSV(),
+        parquet=DwrCymruParquet() if args.parquet else None,
+        write_parquet=args.parquet,
+        deltas=args.delta_storage,
+        keyframe_interval=datetime.timedelta(hours=args.keyframe_hours),
+        dedupe=args.dedupe,
+        codec=ZstdCodec(cache) if args.zstd else None
     )
 
     print(f"Loading {company}")
-    api = DwrCymruAPI()
-    features = api.features()
-    storage.save(company=company, dt=datetime.datetime.now(), items=features)
+    api = DwrCymruAPI(max_workers=args.workers, pbf=args.pbf)
+    storage.save_iter(company=company, dt=datetime.datetime.now(), items=api.iter_features())
@@ -8,11 +8,20 @@ export PYTHONUNBUFFERED=1
 echo $(date) ">>> Processing Stream Data <<<"
 
 echo $(date) " Downloading new information from stream <<<"
-venv/bin/python stream-download.py
+venv/bin/python stream-download.py --parallel 9
 
 echo $(date) " Downloading new information from dwr cymru <<<"
 venv/bin/python dwr-cymru-download.py
 
+echo $(date) " Partitioning the db tables, if they aren't already <<<"
+venv/bin/python stream-partitions.py migrate
+
+echo $(date) " Creating db partitions for the coming months <<<"
+venv/bin/python stream-partitions.py create
+
+echo $(date) " Filling any empty state tables from the history <<<"
+venv/bin/python stream-state.py fill
+
 echo $(date) " Persisting stream files to db <<<"
 venv/bin/python stream-persist-content.py
 
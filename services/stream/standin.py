@@ -0,0 +1,221 @@
+import argparse
+import collections
+import dataclasses
+import datetime
+import itertools
+import json
+import os
+import random
+import re
+import threading
+import time
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, List, Optional, Tuple
+
+from args import enum_parser
+from companies import WaterCompany
+from stream import ArcGisFeatureServer, data_urls
+
+
+# A local stand-in for the water companies' ArcGIS feature servers, replaying recorded responses.
+#
+# A recording is one json file per company, holding the layer metadata, the object ids from
+# returnIdsOnly (duplicates and all) and every feature. Queries for object ids, counts and
+# LastUpdated deltas are answered from those, whatever batch size the client picks.
+
+@dataclasses.dataclass
+class Recording:
+    layer: Dict
+    objectIdFieldName: str
+    objectIds: List[int]
+    features: List[Dict]
+
+    def by_id(self) -> Dict[int, Dict]:
+        return {f['attributes'][self.objectIdFieldName]: f for f in self.features}
+
+
+def recording_path(directory: str, company: WaterCompany) -> str:
+    return os.path.join(directory, f"{company.name}.json")
+
+
+def load_recordings(directory: str) -> Dict[WaterCompany, Recording]:
+    recordings = {}
+    for company in WaterCompany:
+        path = recording_path(directory, company)
+        if os.path.exists(path):
+            with open(path) as f:
+                recordings[company] = Recording(**json.load(f))
+    return recordings
+
+
+def record(company: WaterCompany, directory: str):
+    server = ArcGisFeatureServer(data_urls[company], batch_size=100)
+
+    response = server.session.get(server.layer_uri, params={'f': 'json'})
+    response.raise_for_status()
+    layer = response.json()
+
+    response = server.session.get(server.base_uri, params={
+        'where': '1=1',
+        'f': 'json',
+        'returnIdsOnly': 'true'
+    })
+    response.raise_for_status()
+    ids = response.json()
+
+    features = []
+    for group in itertools.batched(sorted(set(ids['objectIds'])), 100):
+        features.extend(server._fetch(list(group), 'json').json()['features'])
+
+    os.makedirs(directory, exist_ok=True)
+    with open(recording_path(directory, company), 'w') as f:
+        json.dump(dataclasses.asdict(Recording(
+            layer=layer,
+            objectIdFieldName=ids['objectIdFieldName'],
+            objectIds=ids['objectIds'],
+            features=features
+        )), f)
+
+    print(f"{company}: recorded {len(features)} features")
+
+
+LAST_UPDATED = re.compile(r"LastUpdated\s*>\s*timestamp\s*'([^']+)'", re.IGNORECASE)
+
+
+class StandInServer:
+
+    def __init__(self, recordings: Dict[WaterCompany, Recording], port: int = 8765, latency: float = 0.0,
+                 error_rate: float = 0.0):
+        self.recordings = recordings
+        self.by_id = {company: recording.by_id() for company, recording in recordings.items()}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = collections.Counter()
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self.thread: Optional[threading.Thread] = None
+
+    def uri(self, company: WaterCompany) -> str:
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}/{company.name}/FeatureServer/0/query"
+
+    def __enter__(self) -> 'StandInServer':
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _count(self, kind: str):
+        with self.lock:
+            self.requests[kind] += 1
+
+    def _answer(self, company: WaterCompany, query: bool, params: Dict[str, str]) -> Tuple[int, Dict]:
+        recording = self.recordings[company]
+
+        if not query:
+            self._count('layer')
+            return 200, recording.layer
+
+        if params.get('f', 'json') != 'json':
+            self._count('unsupported')
+            return 200, {'error': {'code': 400, 'message': f"Unsupported format {params.get('f')}"}}
+
+        ids = recording.objectIds
+        delta = LAST_UPDATED.search(params.get('where', ''))
+        if delta:
+            since = datetime.datetime.fromisoformat(delta.group(1)).replace(tzinfo=datetime.UTC).timestamp() * 1000
+            ids = [i for i in ids if (self.by_id[company][i]['attributes'].get('LastUpdated') or 0) > since]
+
+        if params.get('returnCountOnly') == 'true':
+            self._count('count')
+            if params.get('returnDistinctValues') == 'true':
+                field = params.get('outFields', '')
+                return 200, {'count': len({self.by_id[company][i]['attributes'].get(field) for i in set(ids)})}
+            return 200, {'count': len(ids)}
+
+        if params.get('returnIdsOnly') == 'true':
+            self._count('ids')
+            return 200, {'objectIdFieldName': recording.objectIdFieldName, 'objectIds': ids}
+
+        self._count('features')
+        wanted = [int(i) for i in params.get('objectIds', '').split(',') if i]
+        return 200, {
+            'objectIdFieldName': recording.objectIdFieldName,
+            'features': [self.by_id[company][i] for i in wanted if i in self.by_id[company]]
+        }
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _respond(self, params: Dict[str, str]):
+                if server.latency:
+                    time.sleep(server.latency)
+
+                if server.error_rate and random.random() < server.error_rate:
+                    server._count('errors')
+                    self.send_error(503)
+                    return
+
+                path = urllib.parse.urlsplit(self.path).path.strip('/').split('/')
+                try:
+                    company = WaterCompany[path[0]]
+                except KeyError:
+                    self.send_error(404)
+                    return
+                if company not in server.recordings:
+                    self.send_error(404)
+                    return
+
+                status, body = server._answer(company, query=path[-1] == 'query', params=params)
+                content = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_GET(self):
+                query = urllib.parse.urlsplit(self.path).query
+                self._respond(dict(urllib.parse.parse_qsl(query)))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+                self._respond(dict(urllib.parse.parse_qsl(body)))
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record, or serve recorded, arcgis feature server responses")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    rec = subparsers.add_parser("record", help="record responses from the live services")
+    rec.add_argument("--company", type=enum_parser(WaterCompany), nargs="+", help="company (default: all)")
+    rec.add_argument("--directory", default="recordings")
+
+    serve = subparsers.add_parser("serve", help="serve recorded responses")
+    serve.add_argument("--directory", default="recordings")
+    serve.add_argument("--port", type=int, default=8765)
+    serve.add_argument("--latency", type=float, default=0.0, help="seconds added to each request")
+    serve.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that fail with a 503")
+
+    args = parser.parse_args()
+
+    match args.command:
+        case "record":
+            for company in args.company or list(WaterCompany):
+                record(company, args.directory)
+        case "serve":
+            with StandInServer(load_recordings(args.directory), port=args.port, latency=args.latency,
+                               error_rate=args.error_rate) as standin:
+                for company in standin.recordings:
+                    print(f"{company}: {standin.uri(company)}")
+                standin.thread.join()
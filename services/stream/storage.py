@@ -1,37 +1,35 @@
+import atexit
 import csv
 import datetime
+import functools
 import gzip
+import hashlib
 import itertools
+import json
 import os
-from dataclasses import asdict, fields, Field
-from io import StringIO
-from typing import List, Dict, Optional, TypeVar, Callable, get_origin, Union, get_args, Tuple, Any, Generator
+import sqlite3
+import tempfile
+import threading
+from collections import deque, Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, fields, Field, dataclass
+from io import StringIO, TextIOWrapper, BytesIO
+from typing import List, Dict, Set, Optional, TypeVar, Callable, get_origin, Union, get_args, Tuple, Any, Generator, \
+    Iterable, Iterator, TextIO, BinaryIO
 
 import boto3
 import botocore.exceptions
 import mypy_boto3_s3.service_resource as s3_resources
+import pyarrow as pa
+import pyarrow.parquet as pq
+import zstandard as zstd
 from botocore.config import Config
-from sqlitedict import SqliteDict
+import sqlitedict
 
+import bundle
 from companies import WaterCompany
 from stream import DwrCymruRecord, FeatureRecord
 
-K = TypeVar("K")
-V = TypeVar("V")
-
-
-class KeyDefaultDict(dict[K, V]):
-    def __init__(self, default_factory: Callable[[K], V]):
-        super().__init__()
-        self.default_factory = default_factory
-
-    def __missing__(self, key: K) -> V:
-        if self.default_factory is None:
-            raise KeyError(key)
-        else:
-            ret = self[key] = self.default_factory(key)
-            return ret
-
 
 def serialize_field(value):
     if isinstance(value, datetime.datetime):
@@ -39,7 +37,9 @@ def serialize_field(value):
     return value
 
 
-dt_cache = KeyDefaultDict(lambda x: datetime.datetime.fromisoformat(x))
+# most timestamps in a file were in the previous one too, but over a long backfill nearly every string is new,
+# so keep the recently seen ones rather than all of them. shared by all CSVFiles - see parse_datetime.cache_info()
+parse_datetime = functools.lru_cache(maxsize=65536)(datetime.datetime.fromisoformat)
 
 
 def is_optional(field_type) -> Tuple[bool, Any]:
@@ -59,12 +59,21 @@ def deserialize_field(field_type, value:str):
         if value == "":
             return None
         if t == datetime.datetime:
-            return dt_cache[value]
+            return parse_datetime(value)
     if t == datetime.datetime:
-        return dt_cache[value]
+        return parse_datetime(value)
     return t(value)
 
 
+def field_parser(field_type) -> Callable[[str], Any]:
+    """does the same as deserialize_field, with the type reflection done up front"""
+    opt, t = is_optional(field_type)
+    parse = parse_datetime if t == datetime.datetime else t
+    if opt:
+        return lambda v: None if (v := v.strip()) == "" else parse(v)
+    return lambda v: parse(v.strip())
+
+
 def mapout(d: Dict) -> Dict:
     return {k: serialize_field(v) for (k, v) in d.items()}
 
@@ -76,26 +85,106 @@ def mapin(t: Dict, d: Dict) -> Dict:
 T = TypeVar("T")
 
 
+@dataclass(frozen=True)
+class Delta[T]:
+    """the changes from the keyframe at base - rows that are new or different, and the keys of rows that have gone"""
+    base: datetime.datetime
+    puts: List[T]
+    deletes: List[str]
+
+    def apply(self, keyframe: List[T], key: Callable[[T], str]) -> List[T]:
+        puts = {key(i): i for i in self.puts}
+        deletes = set(self.deletes)
+        items = [puts.pop(key(i), i) for i in keyframe if key(i) not in deletes]
+        return items + list(puts.values())
+
+
 class CSVFile[T]:
     def _fields(self) -> List[Field]:
         raise NotImplementedError()
 
-    def _construct(self, **kwargs) -> T:
+    def _construct(self, *args) -> T:
+        """args are in field order"""
         raise NotImplementedError()
 
-    def to_csv(self, items: List[T]) -> str:
-        file = StringIO()
+    def key(self, item: T) -> str:
+        """what identifies a row from one snapshot to the next"""
+        raise NotImplementedError()
+
+    def row(self, item: T) -> Tuple[str, ...]:
+        """the item as it'd be written - so a record from the API compares equal to the same one read back from a file"""
+        return tuple('' if v is None else str(serialize_field(v)) for v in (getattr(item, n) for n in self._names))
+
+    @functools.cached_property
+    def _names(self) -> List[str]:
+        return [f.name for f in self._fields()]
+
+    def content_hash(self, items: Iterable[T]) -> str:
+        """the same for the same rows, whatever order they're in"""
+        rows = sorted(hashlib.sha256('\x1f'.join(self.row(item)).encode()).digest() for item in items)
+        return hashlib.sha256(b''.join(rows)).hexdigest()
+
+    @functools.cached_property
+    def _parsers(self) -> List[Tuple[str, Callable[[str], Any]]]:
+        return [(f.name, field_parser(f.type)) for f in self._fields()]
+
+    def _plan(self, header: List[str]) -> List[Tuple[int, Callable[[str], Any]]]:
+        # which column each field comes from - files haven't always had the columns in field order
+        columns = {name: i for i, name in enumerate(header)}
+        try:
+            return [(columns[name], parse) for name, parse in self._parsers]
+        except KeyError as e:
+            raise ValueError(f"CSV has no column {e}, header is {header}")
+
+    def write_csv(self, items: Iterable[T], file: TextIO):
         c = csv.DictWriter(file, fieldnames=[f.name for f in self._fields()])
         c.writeheader()
         for item in items:
             c.writerow(mapout(asdict(item)))
+
+    def to_csv(self, items: List[T]) -> str:
+        file = StringIO()
+        self.write_csv(items, file)
         return file.getvalue()
 
     def from_csv(self, input: str) -> List[T]:
-        file = StringIO(input)
-        types = {f.name: f.type for f in self._fields()}
-        c = csv.DictReader(file)
-        return [self._construct(**mapin(types, r)) for r in c]
+        c = csv.reader(StringIO(input))
+        header = next(c, None)
+        if header is None:
+            return []
+        plan = self._plan(header)
+        construct = self._construct
+        return [construct(*[parse(row[i]) for i, parse in plan]) for row in c if row]
+
+    def write_delta(self, delta: Delta[T], file: TextIO):
+        # the fields, with an op and key column in front - the first row says which keyframe it's from
+        names = [f.name for f in self._fields()]
+        blank = [''] * len(names)
+        c = csv.writer(file)
+        c.writerow(['op', 'key'] + names)
+        c.writerow(['base', delta.base.strftime('%Y%m%d%H%M%S')] + blank)
+        for item in delta.puts:
+            values = mapout(asdict(item))
+            c.writerow(['put', self.key(item)] + [values[n] for n in names])
+        for key in delta.deletes:
+            c.writerow(['del', key] + blank)
+
+    def from_delta(self, input: str) -> Delta[T]:
+        c = csv.reader(StringIO(input))
+        plan = self._plan(next(c))
+        construct = self._construct
+        base, puts, deletes = None, [], []
+        for row in c:
+            match row[0] if row else None:
+                case 'base':
+                    base = datetime.datetime.strptime(row[1], '%Y%m%d%H%M%S').replace(tzinfo=datetime.UTC)
+                case 'put':
+                    puts.append(construct(*[parse(row[i]) for i, parse in plan]))
+                case 'del':
+                    deletes.append(row[1])
+        if base is None:
+            raise ValueError("Delta has no base row")
+        return Delta(base, puts, deletes)
 
 
 class StreamCSV(CSVFile[FeatureRecord]):
@@ -103,16 +192,128 @@ class StreamCSV(CSVFile[FeatureRecord]):
     def _fields(self) -> List[Field]:
         return fields(FeatureRecord)
 
-    def _construct(self, **kwargs) -> T:
-        return FeatureRecord(**kwargs)
+    def _construct(self, *args) -> T:
+        return FeatureRecord(*args)
+
+    def key(self, item: FeatureRecord) -> str:
+        return item.id
 
 
 class DwrCymruCSV(CSVFile[DwrCymruRecord]):
     def _fields(self) -> List[Field]:
         return fields(DwrCymruRecord)
 
-    def _construct(self, **kwargs) -> T:
-        return DwrCymruRecord(**kwargs)
+    def _construct(self, *args) -> T:
+        return DwrCymruRecord(*args)
+
+    def key(self, item: DwrCymruRecord) -> str:
+        return item.assetid
+
+
+class ParquetFile[T]:
+    """the same records as a CSVFile, stored as typed columns"""
+
+    suffix = '.parquet'
+
+    arrow_types = {
+        str: pa.string(),
+        float: pa.float64(),
+        int: pa.int64(),
+    }
+
+    def __init__(self, csvfile: CSVFile[T], row_group_size: int = 65536):
+        self.csvfile = csvfile
+        self.row_group_size = row_group_size
+
+    def _column(self, field_type, values: List[Any]) -> pa.Array:
+        _, t = is_optional(field_type)
+        if t == datetime.datetime:
+            # dwr cymru has some naive times - keep them naive
+            first = next((v for v in values if v is not None), None)
+            tz = 'UTC' if first is None or first.tzinfo is not None else None
+            return pa.array(values, type=pa.timestamp('us', tz=tz))
+        return pa.array([None if v is None else t(v) for v in values], type=self.arrow_types[t])
+
+    def _table(self, items: List[T]) -> pa.Table:
+        record_fields = self.csvfile._fields()
+        return pa.table({
+            f.name: self._column(f.type, [getattr(item, f.name) for item in items]) for f in record_fields
+        })
+
+    def passthrough(self, items: Iterable[T], file: BinaryIO) -> Iterator[T]:
+        """yields the items, writing them to file a row group at a time as they go past"""
+        writer = None
+        for batch in itertools.batched(items, self.row_group_size):
+            table = self._table(list(batch))
+            if writer is None:
+                writer = pq.ParquetWriter(file, table.schema, compression='zstd')
+            # the first row group decides whether a time column is naive
+            writer.write_table(table.cast(writer.schema))
+            yield from batch
+        if writer is None:
+            writer = pq.ParquetWriter(file, self._table([]).schema, compression='zstd')
+        writer.close()
+
+    def write(self, items: Iterable[T], file: BinaryIO):
+        for _ in self.passthrough(items, file):
+            pass
+
+    def columns(self, data: bytes) -> pa.Table:
+        return pq.read_table(pa.BufferReader(data))
+
+    @staticmethod
+    def _values(column: pa.ChunkedArray) -> List[Any]:
+        if not pa.types.is_timestamp(column.type):
+            return column.to_pylist()
+        # much quicker than letting arrow build each datetime, and gives datetime.UTC like the csv does
+        epoch = datetime.datetime(1970, 1, 1, tzinfo=datetime.UTC if column.type.tz else None)
+        micros = column.cast(pa.timestamp('us', tz=column.type.tz)).cast(pa.int64()).to_pylist()
+        return [None if v is None else epoch + datetime.timedelta(microseconds=v) for v in micros]
+
+    def from_parquet(self, data: bytes) -> List[T]:
+        table = self.columns(data)
+        construct = self.csvfile._construct
+        columns = [self._values(table.column(f.name)) for f in self.csvfile._fields()]
+        return [construct(*row) for row in zip(*columns)]
+
+
+class StreamParquet(ParquetFile[FeatureRecord]):
+    def __init__(self):
+        super().__init__(StreamCSV())
+
+
+class DwrCymruParquet(ParquetFile[DwrCymruRecord]):
+    def __init__(self):
+        super().__init__(DwrCymruCSV())
+
+
+DELTA_SUFFIX = '.delta.csv.gz'
+REFERENCE_SUFFIX = '.ref'
+
+# longest first - a delta is a .csv.gz too
+SUFFIXES = (DELTA_SUFFIX, '.csv.gz', '.csv.zst', ParquetFile.suffix, REFERENCE_SUFFIX)
+
+
+def key_format(key: str) -> Optional[Tuple[datetime.datetime, str]]:
+    """the time of the snapshot in a key, and which of the SUFFIXES it's stored as"""
+    name = key.split('/')[-1]
+    for suffix in SUFFIXES:
+        if name.endswith(suffix):
+            dt = datetime.datetime.strptime(name.removesuffix(suffix), '%Y%m%d%H%M%S').replace(tzinfo=datetime.UTC)
+            return dt, suffix
+    return None
+
+
+def key_time(key: str) -> Optional[datetime.datetime]:
+    return None if (found := key_format(key)) is None else found[0]
+
+
+def formats_of(keys: Iterable[str]) -> Dict[datetime.datetime, Set[str]]:
+    formats = {}
+    for found in (key_format(k) for k in keys):
+        if found is not None:
+            formats.setdefault(found[0], set()).add(found[1])
+    return formats
 
 
 class Storage:
@@ -123,39 +324,166 @@ class Storage:
     def load(self, company: WaterCompany, dt: datetime.datetime) -> Optional[str]:
         raise NotImplementedError()
 
+    def suffixes(self, company: WaterCompany, dt: datetime.datetime) -> Optional[Set[str]]:
+        """which of the SUFFIXES the snapshot at dt is stored as, or None if that can't be told without trying them"""
+        return None
+
     def save(self, company: WaterCompany, dt: datetime.datetime, content: str):
         raise NotImplementedError()
 
+    def save_compressed(self, company: WaterCompany, dt: datetime.datetime, content: BinaryIO):
+        """content is an already gzipped csv, positioned at the start"""
+        self.save(company, dt, gzip.decompress(content.read()).decode())
+
+    def load_blob(self, company: WaterCompany, dt: datetime.datetime, suffix: str) -> Optional[bytes]:
+        """the stored bytes of the file with the given suffix, or None if there isn't one"""
+        raise NotImplementedError()
+
+    def save_blob(self, company: WaterCompany, dt: datetime.datetime, suffix: str, content: BinaryIO):
+        raise NotImplementedError()
+
+    def load_dictionary(self, company: WaterCompany, dict_id: Optional[int] = None) -> Optional[bytes]:
+        """a compression dictionary by id, or the one to use now if dict_id is None"""
+        raise NotImplementedError()
+
+    def save_dictionary(self, company: WaterCompany, dict_id: int, content: bytes):
+        """saves it, and makes it the one to use now"""
+        raise NotImplementedError()
+
 
 class SqlliteStorage(Storage):
-    def __init__(self, delegate: Optional[Storage]):
+    """a local cache of the files in front of another Storage (or on its own), kept to max_bytes by evicting
+    the least recently used. writes are committed every commit_every changes, and at exit"""
+
+    def __init__(self, delegate: Optional[Storage], filename: Optional[str] = None, max_bytes: Optional[int] = None,
+                 commit_every: int = 100):
         self.delegate = delegate
-        totp = os.path.expanduser("~/.totp")
-        os.makedirs(totp, exist_ok=True)
-        self.cache = SqliteDict(
-            filename=str(os.path.join(totp, "b2-stream-cache.sqlite")),
-            autocommit=True
+        if filename is None:
+            totp = os.path.expanduser("~/.totp")
+            os.makedirs(totp, exist_ok=True)
+            filename = str(os.path.join(totp, "b2-stream-cache.sqlite"))
+        self.max_bytes = max_bytes
+        self.commit_every = commit_every
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.uncommitted = 0
+        self.counts = Counter()
+        self._create()
+        self.size, self.uses = self.db.execute(
+            "select coalesce(sum(size), 0), coalesce(max(last_used), 0) from files"
+        ).fetchone()
+        atexit.register(self.commit)
+
+    def _create(self):
+        with self.lock:
+            self.db.execute(
+                "create table if not exists files (key text primary key, company text not null, "
+                "file_time integer not null, size integer not null, last_used integer not null, content blob not null)"
+            )
+            self.db.execute("create index if not exists files_company_time on files (company, file_time)")
+            self.db.execute("create index if not exists files_last_used on files (last_used)")
+            self.db.execute("create table if not exists stats (name text primary key, value integer not null)")
+            self.db.execute(
+                "create table if not exists dictionaries (company text not null, dict_id integer not null, "
+                "content blob not null, primary key (company, dict_id))"
+            )
+            self.db.commit()
+            self._migrate()
+
+    def _migrate(self):
+        # once only - this used to be a SqliteDict, with a separate catalogue table
+        tables = {name for (name,) in self.db.execute("select name from sqlite_master where type = 'table'")}
+        if 'unnamed' not in tables:
+            return
+        print("Moving cached files out of the SqliteDict table")
+        cursor = self.db.execute("select key, value from unnamed")
+        while rows := cursor.fetchmany(1000):
+            self.db.executemany(
+                "insert or ignore into files (key, company, file_time, size, last_used, content) "
+                "values (?, ?, ?, ?, ?, ?)",
+                [(k, k.split('/')[0], int(t.timestamp()), len(c), 0, c) for k, t, c in
+                 ((k, key_time(k), sqlitedict.decode(v)) for k, v in rows) if t is not None]
+            )
+        self.db.execute("drop table unnamed")
+        self.db.execute("drop table if exists catalogue")
+        self.db.commit()
+
+    def _filename(self, company: WaterCompany, dt: datetime.datetime, suffix: str = '.csv.gz'):
+        return f"{company.name}/{dt.strftime('%Y%m%d%H%M%S')}{suffix}"
+
+    def _changed(self, n: int = 1):
+        """call holding the lock"""
+        self.uncommitted += n
+        if self.uncommitted >= self.commit_every:
+            self._commit()
+
+    def _commit(self):
+        """call holding the lock"""
+        self.db.executemany(
+            "insert into stats (name, value) values (?, ?) on conflict (name) do update set value = value + excluded.value",
+            list(self.counts.items())
         )
-
-    def _filename(self, company: WaterCompany, dt: datetime.datetime):
-        return f"{company.name}/{dt.strftime('%Y%m%d%H%M%S')}.csv.gz"
+        self.counts.clear()
+        self.db.commit()
+        self.uncommitted = 0
+
+    def commit(self):
+        with self.lock:
+            self._commit()
+
+    def evict(self):
+        with self.lock:
+            if self.max_bytes is not None and self.size > self.max_bytes:
+                self._evict()
+            self._commit()
+
+    def _use(self) -> int:
+        """call holding the lock - last_used is a count of reads and writes, not a time, so there are no ties"""
+        self.uses += 1
+        return self.uses
+
+    def _get(self, filename: str) -> Optional[bytes]:
+        with self.lock:
+            row = self.db.execute("select content from files where key = ?", (filename,)).fetchone()
+            if row is None:
+                self.counts['misses'] += 1
+                return None
+            self.counts['hits'] += 1
+            self.db.execute("update files set last_used = ? where key = ?", (self._use(), filename))
+            self._changed()
+            return row[0]
+
+    def _evict(self):
+        """call holding the lock - takes it down to 90% of the budget, so it's not evicting on every put"""
+        target = self.max_bytes * 0.9
+        evicted = []
+        for key, size in self.db.execute("select key, size from files order by last_used, file_time"):
+            if self.size <= target:
+                break
+            evicted.append((key,))
+            self.size -= size
+        self.db.executemany("delete from files where key = ?", evicted)
+        self.counts['evictions'] += len(evicted)
+        self._changed(len(evicted))
 
     def available(self, company: WaterCompany, since: datetime.datetime) -> Generator[datetime.datetime, Any, None]:
 
         if self.delegate is not None:
             yield from self.delegate.available(company, since)
         else:
-            keys = [k.split('/')[-1].replace('.csv.gz', '') for k in self.cache.keys() if k.startswith(f"{company.name}/")]
-            all_dates = {datetime.datetime.strptime(k, '%Y%m%d%H%M%S').replace(tzinfo=datetime.UTC) for k in keys}
-            dates = {d for d in all_dates if d > since}
-            for file in sorted(list(dates)):
-                yield file
+            with self.lock:
+                rows = self.db.execute(
+                    "select distinct file_time from files where company = ? and file_time > ? order by file_time",
+                    (company.name, int(since.timestamp()))
+                ).fetchall()
+            for (file_time,) in rows:
+                yield datetime.datetime.fromtimestamp(file_time, tz=datetime.UTC)
 
     def load(self, company: WaterCompany, dt: datetime.datetime) -> Optional[str]:
-        filename = self._filename(company, dt)
-        if filename in self.cache:
+        cached = self._get(self._filename(company, dt))
+        if cached is not None:
             print(f"Cache Load: {company} {dt}")
-            return gzip.decompress(self.cache[filename]).decode()
+            return gzip.decompress(cached).decode()
         if self.delegate is not None:
             content = self.delegate.load(company, dt)
             if content is not None:
@@ -164,39 +492,365 @@ class SqlliteStorage(Storage):
         raise FileNotFoundError(f"{company}: can't load {dt} - no such file")
 
     def _put(self, company: WaterCompany, dt: datetime.datetime, content: str):
-        self.cache[self._filename(company, dt)] = gzip.compress(content.encode())
+        self._put_blob(company, dt, '.csv.gz', gzip.compress(content.encode()))
+
+    def _put_blob(self, company: WaterCompany, dt: datetime.datetime, suffix: str, content: bytes):
+        filename = self._filename(company, dt, suffix)
+        with self.lock:
+            previous = self.db.execute("select size from files where key = ?", (filename,)).fetchone()
+            self.db.execute(
+                "insert or replace into files (key, company, file_time, size, last_used, content) "
+                "values (?, ?, ?, ?, ?, ?)",
+                (filename, company.name, int(dt.timestamp()), len(content), self._use(), content)
+            )
+            self.size += len(content) - (previous[0] if previous else 0)
+            self.counts['puts'] += 1
+            self._changed()
+            if self.max_bytes is not None and self.size > self.max_bytes:
+                self._evict()
 
     def save(self, company: WaterCompany, dt: datetime.datetime, content: str):
         if self.delegate is not None:
             self.delegate.save(company, dt, content)
         self._put(company, dt, content)
 
+    def save_compressed(self, company: WaterCompany, dt: datetime.datetime, content: BinaryIO):
+        self.save_blob(company, dt, '.csv.gz', content)
+
+    def suffixes(self, company: WaterCompany, dt: datetime.datetime) -> Optional[Set[str]]:
+        with self.lock:
+            keys = [k for (k,) in self.db.execute("select key from files where company = ? and file_time = ?",
+                                                  (company.name, int(dt.timestamp())))]
+        local = formats_of(keys).get(dt.replace(microsecond=0), set())
+        # a snapshot is saved in only one of the csv formats - a parquet copy on its own doesn't say which
+        if local - {ParquetFile.suffix} or self.delegate is None:
+            return local
+        return self.delegate.suffixes(company, dt)
+
+    def load_blob(self, company: WaterCompany, dt: datetime.datetime, suffix: str) -> Optional[bytes]:
+        cached = self._get(self._filename(company, dt, suffix))
+        if cached is not None:
+            print(f"Cache Load: {company} {dt} {suffix}")
+            return cached
+        if self.delegate is not None:
+            content = self.delegate.load_blob(company, dt, suffix)
+            if content is not None:
+                self._put_blob(company, dt, suffix, content)
+            return content
+        return None
+
+    def save_blob(self, company: WaterCompany, dt: datetime.datetime, suffix: str, content: BinaryIO):
+        if self.delegate is not None:
+            self.delegate.save_blob(company, dt, suffix, content)
+            content.seek(0)
+        self._put_blob(company, dt, suffix, content.read())
+
+    def load_dictionary(self, company: WaterCompany, dict_id: Optional[int] = None) -> Optional[bytes]:
+        if dict_id is None:
+            if self.delegate is not None:
+                return self.delegate.load_dictionary(company)
+            with self.lock:
+                row = self.db.execute("select content from dictionaries where company = ? order by rowid desc limit 1",
+                                      (company.name,)).fetchone()
+            return None if row is None else row[0]
+        with self.lock:
+            row = self.db.execute("select content from dictionaries where company = ? and dict_id = ?",
+                                  (company.name, dict_id)).fetchone()
+        if row is not None:
+            return row[0]
+        if self.delegate is None:
+            return None
+        content = self.delegate.load_dictionary(company, dict_id)
+        if content is not None:
+            self._put_dictionary(company, dict_id, content)
+        return content
+
+    def _put_dictionary(self, company: WaterCompany, dict_id: int, content: bytes):
+        with self.lock:
+            self.db.execute("delete from dictionaries where company = ? and dict_id = ?", (company.name, dict_id))
+            self.db.execute("insert into dictionaries (company, dict_id, content) values (?, ?, ?)",
+                            (company.name, dict_id, content))
+            self._commit()
+
+    def save_dictionary(self, company: WaterCompany, dict_id: int, content: bytes):
+        if self.delegate is not None:
+            self.delegate.save_dictionary(company, dict_id, content)
+        self._put_dictionary(company, dict_id, content)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            self._commit()
+            counts = dict(self.db.execute("select name, value from stats").fetchall())
+            companies = self.db.execute(
+                "select company, count(*), sum(size), min(file_time), max(file_time) from files "
+                "group by company order by company"
+            ).fetchall()
+        lookups = counts.get('hits', 0) + counts.get('misses', 0)
+        return {
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'files': sum(c[1] for c in companies),
+            'hit_rate': counts.get('hits', 0) / lookups if lookups else None,
+            **counts,
+            'companies': [
+                {
+                    'company': company,
+                    'files': files,
+                    'bytes': size,
+                    'oldest': datetime.datetime.fromtimestamp(oldest, tz=datetime.UTC),
+                    'newest': datetime.datetime.fromtimestamp(newest, tz=datetime.UTC),
+                } for company, files, size, oldest, newest in companies
+            ]
+        }
+
+
+def months_between(start: datetime.date, end: datetime.date) -> List[datetime.date]:
+    months = []
+    month = start.replace(day=1)
+    while month <= end:
+        months.append(month)
+        month = (month + datetime.timedelta(days=32)).replace(day=1)
+    return months
+
+
+def not_found(e: botocore.exceptions.ClientError) -> bool:
+    return e.response['Error']['Code'] in {'NoSuchKey', '404'}
+
+
+def precondition_failed(e: botocore.exceptions.ClientError) -> bool:
+    return e.response['Error']['Code'] in {'PreconditionFailed', '412', 'ConditionalRequestConflict', '409'}
+
+
+BUNDLE_NAME = 'bundle.bin'
+
 
 class S3Storage(Storage):
-    def __init__(self, bucket: s3_resources.Bucket):
+    def __init__(self, bucket: s3_resources.Bucket, list_workers: int = 8, bundle_reads: str = 'whole',
+                 bundle_cache: int = 2):
+        """past days may have been packed into a bundle (see compact) - bundle_reads 'whole' fetches a day's bundle
+        in one request and keeps the last bundle_cache of them, for backfills; 'range' fetches just the index and
+        then each file as it's wanted"""
         self.bucket = bucket
+        # boto3 resources aren't thread safe, but clients are - so reads and writes go through the client
+        self.client = bucket.meta.client
+        self.list_workers = list_workers
+        self.bundle_reads = bundle_reads
+        self.bundle_cache = bundle_cache
+        self.bundles: OrderedDict[Tuple[WaterCompany, datetime.date, bool], Tuple[threading.Event, List]] = OrderedDict()
+        self.bundles_lock = threading.Lock()
+        # the formats of each snapshot on the last few days listed
+        self.listings: OrderedDict[Tuple[WaterCompany, datetime.date], Dict[datetime.datetime, Set[str]]] = OrderedDict()
+        self.listings_lock = threading.Lock()
+
+    def _day_keys(self, company: WaterCompany, date: datetime.date) -> List[str]:
+        folder = date.strftime("%Y/%m/%d")
+        pages = self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket.name,
+                                                                      Prefix=f"{company.name}/{folder}/")
+        return [i['Key'] for page in pages for i in page.get('Contents', [])]
+
+    def _day_formats(self, company: WaterCompany, date: datetime.date) -> Dict[datetime.datetime, Set[str]]:
+        names = [i.split('/')[-1] for i in self._day_keys(company, date)]
+        if BUNDLE_NAME in names:
+            index = self._bundle_index(self._bundle_key(company, date))
+            names += index.names() if index is not None else []
+        formats = formats_of(names)
+        with self.listings_lock:
+            self.listings[(company, date)] = formats
+            self.listings.move_to_end((company, date))
+            while len(self.listings) > 4:
+                self.listings.popitem(last=False)
+        return formats
 
     def _files_on(self, company: WaterCompany, date: datetime.date) -> List[datetime.datetime]:
         print(f">> Finding files for {company} on {date}")
-        folder = date.strftime("%Y/%m/%d")
-        items = list(self.bucket.objects.filter(Prefix=f"{company.name}/{folder}/"))
-        keys = [i.key.split('/')[-1].replace('.csv.gz', '') for i in items if i.key.endswith(".csv.gz")]
-        dates = [datetime.datetime.strptime(k, '%Y%m%d%H%M%S').replace(tzinfo=datetime.UTC) for k in keys]
-        return dates
+        # a snapshot may be there in more than one format
+        return sorted(self._day_formats(company, date))
+
+    def suffixes(self, company: WaterCompany, dt: datetime.datetime) -> Optional[Set[str]]:
+        dt = dt.replace(microsecond=0)
+        with self.listings_lock:
+            formats = self.listings.get((company, dt.date()))
+        if formats is None or dt not in formats:
+            # not listed yet, or saved since
+            formats = self._day_formats(company, dt.date())
+        # not there at all may be the old layout, which isn't listed
+        return formats.get(dt)
+
+    def _bundle_key(self, company: WaterCompany, date: datetime.date) -> str:
+        return f"{company.name}/{date.strftime('%Y/%m/%d')}/{BUNDLE_NAME}"
+
+    def _get_range(self, key: str, first: int, last: int) -> Optional[bytes]:
+        try:
+            resp = self.client.get_object(Bucket=self.bucket.name, Key=key, Range=f"bytes={first}-{last}")
+        except botocore.exceptions.ClientError as e:
+            if not_found(e):
+                return None
+            raise
+        return resp['Body'].read()
+
+    def _bundle_index(self, key: str) -> Optional[bundle.BundleIndex]:
+        head = self._get_range(key, 0, 65535)
+        if head is None:
+            return None
+        needed = bundle.header_length(head)
+        if needed > len(head):
+            head = self._get_range(key, 0, needed - 1)
+        return bundle.BundleIndex.parse(head)
+
+    def _fetch_bundle(self, company: WaterCompany, date: datetime.date,
+                      whole: bool) -> Optional[Tuple[bundle.BundleIndex, Optional[bytes]]]:
+        key = self._bundle_key(company, date)
+        if not whole:
+            index = self._bundle_index(key)
+            return None if index is None else (index, None)
+        data = self._get(key)
+        if data is None:
+            return None
+        print(f"S3 Load: {key} ({len(data)} bytes)")
+        return bundle.BundleIndex.parse(data), data
+
+    def _bundle(self, company: WaterCompany, date: datetime.date,
+                whole: bool) -> Optional[Tuple[bundle.BundleIndex, Optional[bytes]]]:
+        """a day's bundle index, and all of it if whole - a few days are kept, and there's only the one request for
+        each even with several threads loading from it"""
+        with self.bundles_lock:
+            # the index comes with the whole bundle, if that's already been asked for
+            key = (company, date, True) if whole or (company, date, True) in self.bundles else (company, date, False)
+            slot = self.bundles.get(key)
+            fetch = slot is None
+            if fetch:
+                slot = self.bundles[key] = (threading.Event(), [])
+                while sum(1 for k in self.bundles if k[2]) > self.bundle_cache or len(self.bundles) > 32:
+                    self.bundles.popitem(last=False)
+            else:
+                self.bundles.move_to_end(key)
+        ready, result = slot
+        if fetch:
+            try:
+                result.append(self._fetch_bundle(company, date, whole=key[2]))
+            except Exception as e:
+                with self.bundles_lock:
+                    self.bundles.pop(key, None)
+                result.append(e)
+            finally:
+                ready.set()
+        else:
+            ready.wait()
+        if isinstance(result[0], Exception):
+            raise result[0]
+        return result[0]
+
+    def _from_bundle(self, company: WaterCompany, dt: datetime.datetime, suffix: str) -> Optional[bytes]:
+        # only finished days are bundled
+        if dt.date() >= datetime.datetime.now(tz=datetime.UTC).date():
+            return None
+        found = self._bundle(company, dt.date(), whole=self.bundle_reads == 'whole')
+        if found is None:
+            return None
+        index, data = found
+        byte_range = index.range(f"{dt.strftime('%Y%m%d%H%M%S')}{suffix}")
+        if byte_range is None:
+            return None
+        first, last = byte_range
+        if data is not None:
+            return data[first:last + 1]
+        if last < first:
+            return b''
+        return self._get_range(self._bundle_key(company, dt.date()), first, last)
+
+    def compact(self, company: WaterCompany, date: datetime.date, delete: bool = False) -> int:
+        """packs a day's files into its bundle, deleting the originals if asked, and returns how many were packed"""
+        bundle_key = self._bundle_key(company, date)
+        keys = [k for k in self._day_keys(company, date) if k != bundle_key]
+        if not keys:
+            return 0
+        existing = self._get(bundle_key)
+        files = bundle.unpack(existing) if existing is not None else {}
+        with ThreadPoolExecutor(max_workers=self.list_workers) as executor:
+            for key, content in zip(keys, executor.map(self._get, keys)):
+                if content is not None:
+                    files[key.split('/')[-1]] = content
+
+        self.client.put_object(Bucket=self.bucket.name, Key=bundle_key, Body=bundle.pack(files))
+
+        packed = self._bundle_index(bundle_key)
+        missing = [k for k in keys if packed.range(k.split('/')[-1]) is None]
+        if missing:
+            raise RuntimeError(f"{company}: {len(missing)} files missing from {bundle_key}")
+        if delete:
+            for group in itertools.batched(keys, 1000):
+                self.client.delete_objects(Bucket=self.bucket.name,
+                                           Delete={'Objects': [{'Key': k} for k in group], 'Quiet': True})
+        return len(keys)
+
+    def _manifest_key(self, company: WaterCompany, month: datetime.date) -> str:
+        return f"{company.name}/{month.strftime('%Y/%m')}/manifest.json"
+
+    def _list_month(self, company: WaterCompany, month: datetime.date) -> List[datetime.datetime]:
+        today = datetime.datetime.now(tz=datetime.UTC).date()
+        end = min((month + datetime.timedelta(days=32)).replace(day=1), today + datetime.timedelta(days=1))
+        dates = [month + datetime.timedelta(days=x) for x in range((end - month).days)]
+        with ThreadPoolExecutor(max_workers=self.list_workers) as executor:
+            return [file for files in executor.map(lambda d: self._files_on(company, d), dates) for file in files]
+
+    def _manifest(self, company: WaterCompany, month: datetime.date) -> Tuple[List[datetime.datetime], Optional[str]]:
+        """the files in a month, and the manifest's etag - or None if there wasn't one and the bucket was listed"""
+        try:
+            resp = self.client.get_object(Bucket=self.bucket.name, Key=self._manifest_key(company, month))
+        except botocore.exceptions.ClientError as e:
+            if not not_found(e):
+                raise
+            return self._list_month(company, month), None
+        files = json.loads(resp['Body'].read())['files']
+        return [datetime.datetime.strptime(f, '%Y%m%d%H%M%S').replace(tzinfo=datetime.UTC) for f in files], resp['ETag']
+
+    def _put_manifest(self, company: WaterCompany, month: datetime.date, files: Iterable[datetime.datetime],
+                      etag: Optional[str]):
+        """only replaces the manifest that was read (etag), or creates one if there wasn't one"""
+        body = json.dumps({'files': [f.strftime('%Y%m%d%H%M%S') for f in sorted(set(files))]})
+        condition = {'IfMatch': etag} if etag is not None else {'IfNoneMatch': '*'}
+        try:
+            self.client.put_object(Bucket=self.bucket.name, Key=self._manifest_key(company, month), Body=body.encode(),
+                                   ContentType='application/json', **condition)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'NotImplemented':
+                raise
+            # no conditional writes here - fine while there's only the one download job writing
+            self.client.put_object(Bucket=self.bucket.name, Key=self._manifest_key(company, month), Body=body.encode(),
+                                   ContentType='application/json')
+
+    def _record(self, company: WaterCompany, dt: datetime.datetime, attempts: int = 5):
+        dt = dt.replace(microsecond=0)
+        month = dt.date().replace(day=1)
+        for _ in range(attempts):
+            files, etag = self._manifest(company, month)
+            if dt in files and etag is not None:
+                return
+            try:
+                self._put_manifest(company, month, set(files) | {dt}, etag)
+                return
+            except botocore.exceptions.ClientError as e:
+                if not precondition_failed(e):
+                    raise
+                print(f">> Manifest for {company} {month:%Y/%m} changed, retrying")
+        raise RuntimeError(f"{company}: couldn't update manifest for {month:%Y/%m}")
+
+    def _month(self, company: WaterCompany, month: datetime.date) -> List[datetime.datetime]:
+        files, etag = self._manifest(company, month)
+        if etag is None:
+            # listed, so write it down for next time - unless someone else just has
+            try:
+                self._put_manifest(company, month, files, None)
+            except botocore.exceptions.ClientError as e:
+                if not precondition_failed(e):
+                    raise
+        return files
 
     def available(self, company: WaterCompany, since: datetime.datetime) -> Generator[datetime.datetime, Any, None]:
-
-        start_date = since.date()
-        end_date = datetime.date.today()
-
-        dates = [start_date + datetime.timedelta(days=x) for x in range((end_date - start_date).days + 1)]
-
-        for date in dates:
-            files_on_date = [d for d in self._files_on(company=company, date=date) if d > since]
-            for file in files_on_date:
-                yield file
-
-
+        months = months_between(since.date(), datetime.datetime.now(tz=datetime.UTC).date())
+        with ThreadPoolExecutor(max_workers=self.list_workers) as executor:
+            for files in executor.map(lambda m: self._month(company, m), months):
+                yield from sorted(f for f in set(files) if f > since)
 
     def migration(self, company: WaterCompany):
 
@@ -214,22 +868,25 @@ class S3Storage(Storage):
         return commands
 
     def load(self, company: WaterCompany, dt: datetime.datetime) -> Optional[str]:
+        bundled = self._from_bundle(company, dt, '.csv.gz')
+        if bundled is not None:
+            return gzip.decompress(bundled).decode()
         print(f"S3 Load: {company} {dt}")
         try:
             new_filename = self._filename_new(company, dt)
-            resp = self.bucket.Object(key=(new_filename)).get()
+            resp = self.client.get_object(Bucket=self.bucket.name, Key=new_filename)
         except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] in {'NoSuchKey', '404'}:
+            if not_found(e):
                 old_filename = self._filename_old(company, dt)
                 print(f">> Trying {old_filename}")
-                resp = self.bucket.Object(key=(old_filename)).get()
+                resp = self.client.get_object(Bucket=self.bucket.name, Key=old_filename)
             else:
                 raise
 
         return gzip.decompress(resp['Body'].read()).decode()
 
-    def _filename_new(self, company: WaterCompany, dt: datetime.datetime):
-        return f"{company.name}/{dt.strftime('%Y/%m/%d/%Y%m%d%H%M%S')}.csv.gz"
+    def _filename_new(self, company: WaterCompany, dt: datetime.datetime, suffix: str = '.csv.gz'):
+        return f"{company.name}/{dt.strftime('%Y/%m/%d/%Y%m%d%H%M%S')}{suffix}"
 
     def _filename_old(self, company: WaterCompany, dt: datetime.datetime):
         return f"{company.name}/{dt.strftime('%Y%m%d%H%M%S')}.csv.gz"
@@ -238,28 +895,354 @@ class S3Storage(Storage):
         filename = self._filename_new(company, dt)
         content = gzip.compress(data=content.encode())
         print(f"Writing {filename}")
-        self.bucket.put_object(Key=filename, Body=content)
+        self.client.put_object(Bucket=self.bucket.name, Key=filename, Body=content)
+        self._record(company, dt)
+
+    def save_compressed(self, company: WaterCompany, dt: datetime.datetime, content: BinaryIO):
+        self.save_blob(company, dt, '.csv.gz', content)
+
+    def load_blob(self, company: WaterCompany, dt: datetime.datetime, suffix: str) -> Optional[bytes]:
+        bundled = self._from_bundle(company, dt, suffix)
+        if bundled is not None:
+            return bundled
+        filename = self._filename_new(company, dt, suffix)
+        try:
+            resp = self.client.get_object(Bucket=self.bucket.name, Key=filename)
+        except botocore.exceptions.ClientError as e:
+            if not_found(e):
+                return None
+            raise
+        print(f"S3 Load: {filename}")
+        return resp['Body'].read()
+
+    def _get(self, key: str) -> Optional[bytes]:
+        try:
+            return self.client.get_object(Bucket=self.bucket.name, Key=key)['Body'].read()
+        except botocore.exceptions.ClientError as e:
+            if not_found(e):
+                return None
+            raise
+
+    def load_dictionary(self, company: WaterCompany, dict_id: Optional[int] = None) -> Optional[bytes]:
+        if dict_id is None:
+            current = self._get(f"{company.name}/dictionaries/current")
+            if current is None:
+                return None
+            dict_id = int(current)
+        return self._get(f"{company.name}/dictionaries/{dict_id}.zdict")
+
+    def save_dictionary(self, company: WaterCompany, dict_id: int, content: bytes):
+        self.client.put_object(Bucket=self.bucket.name, Key=f"{company.name}/dictionaries/{dict_id}.zdict", Body=content)
+        self.client.put_object(Bucket=self.bucket.name, Key=f"{company.name}/dictionaries/current",
+                               Body=str(dict_id).encode())
+
+    def exists(self, company: WaterCompany, dt: datetime.datetime, suffix: str) -> bool:
+        if dt.date() < datetime.datetime.now(tz=datetime.UTC).date():
+            found = self._bundle(company, dt.date(), whole=False)
+            if found is not None and found[0].range(f"{dt.strftime('%Y%m%d%H%M%S')}{suffix}") is not None:
+                return True
+        try:
+            self.client.head_object(Bucket=self.bucket.name, Key=self._filename_new(company, dt, suffix))
+            return True
+        except botocore.exceptions.ClientError as e:
+            if not_found(e):
+                return False
+            raise
+
+    def save_blob(self, company: WaterCompany, dt: datetime.datetime, suffix: str, content: BinaryIO):
+        filename = self._filename_new(company, dt, suffix)
+        print(f"Streaming {filename}")
+        # managed transfer - switches to a multipart upload for large files
+        self.client.upload_fileobj(Fileobj=content, Bucket=self.bucket.name, Key=filename)
+        self._record(company, dt)
+
+
+class ZstdCodec:
+    """zstd, with each company's trained dictionary (see stream-train-dictionary.py) if it has one. the frames say
+    which dictionary they need, so older files still decompress after a new one is trained"""
+
+    suffix = '.csv.zst'
+
+    def __init__(self, storage: Storage, level: int = 9):
+        self.storage = storage
+        self.level = level
+        self.compressors: Dict[WaterCompany, zstd.ZstdCompressor] = {}
+        self.dictionaries: Dict[Tuple[WaterCompany, int], zstd.ZstdCompressionDict] = {}
+        self.lock = threading.Lock()
+
+    def _dictionary(self, company: WaterCompany, dict_id: int) -> zstd.ZstdCompressionDict:
+        with self.lock:
+            cached = self.dictionaries.get((company, dict_id))
+        if cached is not None:
+            return cached
+        content = self.storage.load_dictionary(company, dict_id)
+        if content is None:
+            raise FileNotFoundError(f"{company}: no compression dictionary {dict_id}")
+        dictionary = zstd.ZstdCompressionDict(content)
+        with self.lock:
+            self.dictionaries[(company, dict_id)] = dictionary
+        return dictionary
+
+    def compressor(self, company: WaterCompany) -> zstd.ZstdCompressor:
+        with self.lock:
+            cached = self.compressors.get(company)
+        if cached is not None:
+            return cached
+        content = self.storage.load_dictionary(company)
+        if content is None:
+            compressor = zstd.ZstdCompressor(level=self.level)
+        else:
+            compressor = zstd.ZstdCompressor(level=self.level, dict_data=zstd.ZstdCompressionDict(content))
+        with self.lock:
+            self.compressors[company] = compressor
+        return compressor
+
+    def compress(self, company: WaterCompany, data: bytes) -> bytes:
+        return self.compressor(company).compress(data)
+
+    def decompress(self, company: WaterCompany, data: bytes) -> bytes:
+        dict_id = zstd.get_frame_parameters(data).dict_id
+        if dict_id:
+            decompressor = zstd.ZstdDecompressor(dict_data=self._dictionary(company, dict_id))
+        else:
+            decompressor = zstd.ZstdDecompressor()
+        # streamed frames don't say how big they are
+        return decompressor.decompressobj().decompress(data)
 
 
 class CSVFileStorage[T]:
 
-    def __init__(self, storage: Storage, csvfile: CSVFile[T]):
+    def __init__(self, storage: Storage, csvfile: CSVFile[T], spool_size: int = 8 * 1024 * 1024,
+                 parquet: Optional[ParquetFile[T]] = None, write_parquet: bool = False, deltas: bool = False,
+                 keyframe_interval: datetime.timedelta = datetime.timedelta(days=1), dedupe: bool = False,
+                 codec: Optional[ZstdCodec] = None):
+        """with parquet, snapshots are read from parquet when there is one, csv otherwise.
+        with write_parquet too, a parquet copy is saved alongside each csv.
+        with deltas, a snapshot is saved as its changes from the last full one (a keyframe) if that was within
+        keyframe_interval.
+        with dedupe, a snapshot with the same rows as the one before is saved as a reference to it instead.
+        with codec, full snapshots are saved as .csv.zst. loads read whichever is there, codec or not"""
         self.storage = storage
         self.csvfile = csvfile
+        self.spool_size = spool_size
+        self.parquet = parquet
+        self.write_parquet = write_parquet and parquet is not None
+        self.deltas = deltas
+        self.keyframe_interval = keyframe_interval
+        # the last keyframe used for each company - consecutive deltas are nearly always from the same one
+        self.keyframes: Dict[WaterCompany, Tuple[datetime.datetime, List[T]]] = {}
+        self.keyframes_lock = threading.Lock()
+        self.dedupe = dedupe
+        # the content hash of the last snapshot saved for each company
+        self.hashes: Dict[WaterCompany, Tuple[datetime.datetime, str]] = {}
+        self.codec = codec
+        self.zstd = codec if codec is not None else ZstdCodec(storage)
 
     def available(self, company: WaterCompany, since: datetime.datetime) -> List[datetime.datetime]:
         return self.storage.available(company, since=since)
 
     def save(self, company: WaterCompany, dt: datetime.datetime, items: List[T]):
-        content = self.csvfile.to_csv(items)
-        self.storage.save(company, dt.astimezone(tz=datetime.UTC), content)
+        dt = dt.astimezone(tz=datetime.UTC)
+        content_hash = None
+        if self.dedupe:
+            content_hash = self.csvfile.content_hash(items)
+            if self._save_reference(company, dt, content_hash):
+                return
+        if not (self.deltas and self._save_delta(company, dt, items)):
+            content = self.csvfile.to_csv(items)
+            if self.codec is not None:
+                compressed = self.codec.compress(company, content.encode())
+                self.storage.save_blob(company, dt, self.codec.suffix, BytesIO(compressed))
+            else:
+                self.storage.save(company, dt, content)
+            if self.write_parquet:
+                self.save_parquet(company, dt, items)
+        if content_hash is not None:
+            self.hashes[company] = (dt.replace(microsecond=0), content_hash)
+
+    def save_parquet(self, company: WaterCompany, dt: datetime.datetime, items: Iterable[T]):
+        with tempfile.SpooledTemporaryFile(max_size=self.spool_size) as spool:
+            self.parquet.write(items, spool)
+            spool.seek(0)
+            self.storage.save_blob(company, dt.astimezone(tz=datetime.UTC), self.parquet.suffix, spool)
+
+    def save_iter(self, company: WaterCompany, dt: datetime.datetime, items: Iterable[T]):
+        if self.deltas or self.dedupe:
+            # needs all of them to compare with the keyframe, or the last snapshot
+            self.save(company, dt, list(items))
+            return
+        # rows are compressed as they arrive, only the compressed output is held - and that goes to disk if it gets big
+        with tempfile.SpooledTemporaryFile(max_size=self.spool_size) as spool, \
+                tempfile.SpooledTemporaryFile(max_size=self.spool_size) as columns:
+            if self.write_parquet:
+                items = self.parquet.passthrough(items, columns)
+            if self.codec is not None:
+                compressed = self.codec.compressor(company).stream_writer(spool, closefd=False)
+            else:
+                compressed = gzip.GzipFile(fileobj=spool, mode='wb')
+            with TextIOWrapper(compressed, encoding='utf-8', newline='') as text:
+                self.csvfile.write_csv(items, text)
+            spool.seek(0)
+            if self.codec is not None:
+                self.storage.save_blob(company, dt.astimezone(tz=datetime.UTC), self.codec.suffix, spool)
+            else:
+                self.storage.save_compressed(company, dt.astimezone(tz=datetime.UTC), spool)
+            if self.write_parquet:
+                columns.seek(0)
+                self.storage.save_blob(company, dt.astimezone(tz=datetime.UTC), self.parquet.suffix, columns)
+
+    def _delta(self, company: WaterCompany, dt: datetime.datetime) -> Optional[Delta[T]]:
+        if not self._stored(company, dt, DELTA_SUFFIX):
+            return None
+        data = self.storage.load_blob(company, dt, DELTA_SUFFIX)
+        if data is None:
+            return None
+        return self.csvfile.from_delta(gzip.decompress(data).decode())
+
+    def _keyframe(self, company: WaterCompany, dt: datetime.datetime) -> List[T]:
+        with self.keyframes_lock:
+            cached = self.keyframes.get(company)
+        if cached is not None and cached[0] == dt:
+            return cached[1]
+        items = self._load_full(company, dt)
+        with self.keyframes_lock:
+            self.keyframes[company] = (dt, items)
+        return items
+
+    def _save_delta(self, company: WaterCompany, dt: datetime.datetime, items: List[T]) -> bool:
+        since = dt - self.keyframe_interval
+        latest = max((t for t in self.available(company, since=since) if t < dt), default=None)
+        if latest is None:
+            return False
+        if (ref := self.reference(company, latest)) is not None:
+            latest = ref
+        previous = self._delta(company, latest)
+        base = latest if previous is None else previous.base
+        if base <= since:
+            return False
+
+        # a delta can only say what happened to each key if there's just the one row for it
+        key = self.csvfile.key
+        current = {key(i): i for i in items}
+        keyframe = self._keyframe(company, base)
+        before = {key(i): self.csvfile.row(i) for i in keyframe}
+        if len(current) != len(items) or len(before) != len(keyframe) or not all(current):
+            return False
+
+        # compared as written - records from the API keep their own types, the keyframe's come back from a file
+        row = self.csvfile.row
+        delta = Delta(
+            base=base,
+            puts=[i for k, i in current.items() if before.get(k) != row(i)],
+            deletes=[k for k in before if k not in current]
+        )
+        if len(delta.puts) + len(delta.deletes) > len(items) // 2:
+            return False
+
+        text = StringIO()
+        self.csvfile.write_delta(delta, text)
+        print(f"Delta {company} {dt} from {base}: {len(delta.puts)} changed, {len(delta.deletes)} gone")
+        self.storage.save_blob(company, dt, DELTA_SUFFIX, BytesIO(gzip.compress(text.getvalue().encode())))
+        return True
+
+    def reference(self, company: WaterCompany, dt: datetime.datetime) -> Optional[datetime.datetime]:
+        """if the snapshot at dt was the same as an earlier one, when that one was"""
+        return None if (ref := self._reference(company, dt)) is None else ref[0]
+
+    def _reference(self, company: WaterCompany, dt: datetime.datetime) -> Optional[Tuple[datetime.datetime, str]]:
+        if not self._stored(company, dt, REFERENCE_SUFFIX):
+            return None
+        data = self.storage.load_blob(company, dt, REFERENCE_SUFFIX)
+        if data is None:
+            return None
+        ref = json.loads(data)
+        return datetime.datetime.strptime(ref['ref'], '%Y%m%d%H%M%S').replace(tzinfo=datetime.UTC), ref['hash']
+
+    def _content_hash(self, company: WaterCompany, dt: datetime.datetime) -> Tuple[datetime.datetime, str]:
+        """the original snapshot for dt (itself, unless it's a reference), and its hash"""
+        cached = self.hashes.get(company)
+        if cached is not None and cached[0] == dt:
+            return cached
+        ref = self._reference(company, dt)
+        if ref is not None:
+            return ref
+        return dt, self.csvfile.content_hash(self.load(company, dt))
+
+    def _save_reference(self, company: WaterCompany, dt: datetime.datetime, content_hash: str) -> bool:
+        latest = max((t for t in self.available(company, since=dt - datetime.timedelta(days=1)) if t < dt), default=None)
+        if latest is None:
+            return False
+        original, previous_hash = self._content_hash(company, latest)
+        if previous_hash != content_hash:
+            return False
+        print(f"Unchanged {company} {dt}, same as {original}")
+        ref = json.dumps({'ref': original.strftime('%Y%m%d%H%M%S'), 'hash': content_hash})
+        self.storage.save_blob(company, dt, REFERENCE_SUFFIX, BytesIO(ref.encode()))
+        return True
+
+    def _load_unless_reference(self, company: WaterCompany, dt: datetime.datetime) -> Optional[List[T]]:
+        return None if self.reference(company, dt) is not None else self.load(company, dt)
 
     def load(self, company: WaterCompany, dt: datetime.datetime) -> List[T]:
+        if (ref := self.reference(company, dt)) is not None:
+            dt = ref
+        delta = self._delta(company, dt)
+        if delta is not None:
+            return delta.apply(self._keyframe(company, delta.base), self.csvfile.key)
+        return self._load_full(company, dt)
+
+    def _stored(self, company: WaterCompany, dt: datetime.datetime, suffix: str) -> bool:
+        """whether the snapshot at dt may be stored as suffix - if the storage can't say, it has to be tried"""
+        suffixes = self.storage.suffixes(company, dt)
+        return suffixes is None or suffix in suffixes
+
+    def _load_full(self, company: WaterCompany, dt: datetime.datetime) -> List[T]:
+        if self.parquet is not None and self._stored(company, dt, self.parquet.suffix):
+            data = self.storage.load_blob(company, dt, self.parquet.suffix)
+            if data is not None:
+                return self.parquet.from_parquet(data)
+        if self._stored(company, dt, self.zstd.suffix):
+            data = self.storage.load_blob(company, dt, self.zstd.suffix)
+            if data is not None:
+                return self.csvfile.from_csv(self.zstd.decompress(company, data).decode())
         content = self.storage.load(company, dt)
         if content is None:
             raise FileNotFoundError(f"{company} at {dt}")
         return self.csvfile.from_csv(content)
 
+    def load_ahead(self, company: WaterCompany, timestamps: Iterable[datetime.datetime],
+                   ahead: int = 4, skip_references: bool = False) -> Iterator[Tuple[datetime.datetime, List[T]]]:
+        """loads each snapshot in turn, with the next few downloading and parsing while the caller works on this one.
+        with skip_references, snapshots that are the same as the one before are left out"""
+        load = self._load_unless_reference if skip_references else self.load
+        if ahead < 1:
+            loaded = ((dt, load(company, dt)) for dt in timestamps)
+        else:
+            loaded = self._ahead(load, company, timestamps, ahead)
+        for dt, items in loaded:
+            if items is not None:
+                yield dt, items
+
+    @staticmethod
+    def _ahead(load, company: WaterCompany, timestamps: Iterable[datetime.datetime], ahead: int):
+        with ThreadPoolExecutor(max_workers=ahead) as executor:
+            # at most ahead snapshots waiting, handed back in the order they were asked for
+            pending = deque()
+            for dt in timestamps:
+                pending.append((dt, executor.submit(load, company, dt)))
+                if len(pending) > ahead:
+                    dt, future = pending.popleft()
+                    yield dt, future.result()
+            while pending:
+                dt, future = pending.popleft()
+                yield dt, future.result()
+
+    def latest(self, company: WaterCompany, since: datetime.datetime) -> Optional[Tuple[datetime.datetime, List[T]]]:
+        dt = max(self.available(company, since=since), default=None)
+        if dt is None:
+            return None
+        return dt, self.load(company, dt)
+
 
 test_item = FeatureRecord(
     id="ID",
@@ -0,0 +1,359 @@
+import argparse
+import csv
+import datetime
+import gzip
+import itertools
+import json
+import random
+import tempfile
+import time
+import timeit
+import tracemalloc
+import uuid
+from dataclasses import fields, replace
+from io import StringIO, BytesIO
+from typing import List, Dict, Optional, Iterator
+
+import zstandard as zstd
+
+from args import enum_parser
+from arcgis_pbf import decode_feature_query
+from companies import WaterCompany
+from standin import StandInServer, Recording, load_recordings
+from storage import StreamCSV, mapin, parse_datetime, StreamParquet, SqlliteStorage, key_time
+from stream import StreamAPI, StreamConverter, x, DwrCymruAPI, FeatureRecord, EventType
+
+
+def synthetic_features(count: int) -> List[Dict]:
+    # shaped like a real response - a few distinct update times per batch, lots of ids
+    update_times = [x["LastUpdated"] + i * 900_000 for i in range(4)]
+    return [
+        {"attributes": dict(x, OBJECTID=i, Id=f"NES{i:05}", LastUpdated=random.choice(update_times))}
+        for i in range(count)
+    ]
+
+
+def recorded_features(path: str) -> List[Dict]:
+    with open(path) as f:
+        return json.load(f)["features"]
+
+
+def report(name: str, seconds: float, features: int, repeat: int):
+    per_10k = seconds / repeat / features * 10_000
+    print(f"{name:>24}: {per_10k * 1000:8.2f} ms per 10k")
+    return per_10k
+
+
+def benchmark_convert(features: List[Dict], repeat: int):
+    api = StreamAPI(company=WaterCompany.Northumbrian)
+    attributes = [f["attributes"] for f in features]
+
+    print(f"Converting {len(features)} features, {repeat} times")
+
+    per_record = timeit.timeit(lambda: [api._convert(a) for a in attributes], number=repeat)
+    compiled = timeit.timeit(lambda: StreamConverter(attributes[0]).convert(attributes), number=repeat)
+
+    before = report("per record", per_record, len(features), repeat)
+    after = report("compiled", compiled, len(features), repeat)
+    print(f"{'speed-up':>24}: {before / after:8.2f}x")
+
+
+def benchmark_pbf(company: WaterCompany, batches: int, repeat: int):
+    api = DwrCymruAPI() if company == WaterCompany.DwrCymru else StreamAPI(company=company)
+    batch_size = api._batch_size()
+    ids = api._feature_list().ids[:batch_size * batches]
+
+    json_bytes, pbf_bytes, json_decode, pbf_decode = 0, 0, 0.0, 0.0
+
+    for group in itertools.batched(ids, batch_size):
+        as_json = api._fetch(group, 'json').content
+        as_pbf = api._fetch(group, 'pbf').content
+
+        json_bytes += len(as_json)
+        pbf_bytes += len(as_pbf)
+        json_decode += timeit.timeit(lambda: json.loads(as_json), number=repeat) / repeat
+        pbf_decode += timeit.timeit(lambda: decode_feature_query(as_pbf), number=repeat) / repeat
+
+    print(f"{company}: {len(ids)} features in batches of {batch_size}")
+    print(f"{'json':>24}: {json_bytes:10} bytes {json_decode * 1000:8.2f} ms decode")
+    print(f"{'pbf':>24}: {pbf_bytes:10} bytes {pbf_decode * 1000:8.2f} ms decode")
+    print(f"{'pbf/json':>24}: {pbf_bytes / json_bytes:10.2f} size {pbf_decode / json_decode:8.2f} time")
+
+
+def synthetic_recordings(count: int) -> Dict[WaterCompany, Recording]:
+    features = synthetic_features(count)
+    return {
+        WaterCompany.Northumbrian: Recording(
+            layer={'maxRecordCount': 2000, 'supportedQueryFormats': 'JSON'},
+            objectIdFieldName='OBJECTID',
+            objectIds=[f['attributes']['OBJECTID'] for f in features],
+            features=features
+        )
+    }
+
+
+def benchmark_download(recordings: Dict[WaterCompany, Recording], latency: float, error_rate: float, workers: int,
+                       batch_size: Optional[int], stream: bool):
+    with StandInServer(recordings, latency=latency, error_rate=error_rate) as standin:
+        for company in recordings:
+            if company == WaterCompany.DwrCymru:
+                api = DwrCymruAPI(max_workers=workers, batch_size=batch_size, base_uri=standin.uri(company))
+            else:
+                api = StreamAPI(company=company, max_workers=workers, batch_size=batch_size,
+                                base_uri=standin.uri(company))
+
+            standin.requests.clear()
+            tracemalloc.start()
+            start = time.perf_counter()
+
+            if stream:
+                count = sum(1 for _ in api.iter_features())
+            else:
+                count = len(api.features())
+
+            seconds = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            requests = ", ".join(f"{k}={v}" for k, v in sorted(standin.requests.items()))
+            print(f"{company.name:>16}: {count:7} features {seconds:7.2f}s {count / seconds:9.0f}/s "
+                  f"peak {peak / 1024 / 1024:7.1f}MiB requests: {requests}")
+
+
+def synthetic_records(count: int) -> List[FeatureRecord]:
+    start = datetime.datetime(2025, 1, 1, tzinfo=datetime.UTC)
+    return [
+        FeatureRecord(id=f"NES{i:05}", status=str(random.choice([-1, 0, 1])), company="Northumbrian Water Ltd",
+                      statusStart=start + datetime.timedelta(minutes=random.randrange(100_000)),
+                      latestEventStart=start + datetime.timedelta(minutes=random.randrange(100_000)),
+                      latestEventEnd=random.choice([None, start + datetime.timedelta(minutes=random.randrange(100_000))]),
+                      lastUpdated=start + datetime.timedelta(minutes=15 * random.randrange(4)),
+                      lat=54.60886, lon=-1.13235, receivingWater="Tees Estuary (S Bank)")
+        for i in range(count)
+    ]
+
+
+def benchmark_csv(count: int, repeat: int):
+    csvfile = StreamCSV()
+    records = synthetic_records(count)
+    text = csvfile.to_csv(records)
+    parquet = StreamParquet()
+    columns = BytesIO()
+    parquet.write(records, columns)
+    types = {f.name: f.type for f in fields(FeatureRecord)}
+
+    print(f"Loading {count} records, {repeat} times")
+
+    reflective = timeit.timeit(lambda: [FeatureRecord(**mapin(types, r)) for r in csv.DictReader(StringIO(text))],
+                               number=repeat)
+    compiled = timeit.timeit(lambda: csvfile.from_csv(text), number=repeat)
+    from_parquet = timeit.timeit(lambda: parquet.from_parquet(columns.getvalue()), number=repeat)
+    column_arrays = timeit.timeit(lambda: parquet.columns(columns.getvalue()), number=repeat)
+
+    before = report("DictReader + mapin", reflective, count, repeat)
+    after = report("compiled", compiled, count, repeat)
+    print(f"{'speed-up':>24}: {before / after:8.2f}x")
+    report("parquet records", from_parquet, count, repeat)
+    report("parquet columns", column_arrays, count, repeat)
+    print(f"{'size':>24}: csv {len(text.encode())} bytes, parquet {len(columns.getvalue())} bytes")
+
+
+def replay_timestamps(files: int, rows: int) -> Iterator[List[str]]:
+    # per file: each row's event times rarely change, its update time is new every snapshot
+    replay = random.Random(files * rows)
+    start = datetime.datetime(2025, 1, 1, tzinfo=datetime.UTC)
+    events = [start + datetime.timedelta(minutes=replay.randrange(100_000)) for _ in range(rows)]
+    for n in range(files):
+        updated = start + datetime.timedelta(minutes=15 * n)
+        for i in replay.sample(range(rows), k=max(1, rows // 20)):
+            events[i] = updated - datetime.timedelta(seconds=replay.randrange(900))
+        yield [e.isoformat() for e in events] + [updated.isoformat()] * rows
+
+
+def benchmark_dates(files: int, rows: int):
+    print(f"Replaying {files} files of {rows} rows")
+
+    unbounded = {}
+
+    def unbounded_parse(v: str) -> datetime.datetime:
+        if v not in unbounded:
+            unbounded[v] = datetime.datetime.fromisoformat(v)
+        return unbounded[v]
+
+    for name, parse in [("unbounded dict", unbounded_parse), ("bounded lru", parse_datetime)]:
+        parse_datetime.cache_clear()
+        tracemalloc.start()
+        start = time.perf_counter()
+        for timestamps in replay_timestamps(files, rows):
+            for v in timestamps:
+                parse(v)
+        seconds = time.perf_counter() - start
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name:>24}: {seconds:7.2f}s retained {current / 1024 / 1024:7.1f}MiB")
+
+    print(f"{'lru':>24}: {parse_datetime.cache_info()}")
+
+
+def benchmark_available(files: int, repeat: int):
+    with tempfile.TemporaryDirectory() as directory:
+        storage = SqlliteStorage(delegate=None, filename=f"{directory}/cache.sqlite")
+        start = datetime.datetime(2025, 1, 1, tzinfo=datetime.UTC)
+        companies = list(WaterCompany)
+        for n in range(files):
+            dt = start + datetime.timedelta(minutes=15 * (n // len(companies)))
+            storage._put_blob(companies[n % len(companies)], dt, '.csv.gz', b'')
+        since = start + datetime.timedelta(minutes=15 * (files // len(companies)) - 6 * 60)
+
+        def scan():
+            all_keys = [k for (k,) in storage.db.execute("select key from files")]
+            keys = {key_time(k) for k in all_keys if k.startswith(f"{WaterCompany.Anglian.name}/")}
+            return sorted(d for d in keys if d > since)
+
+        print(f"Finding recent files among {files}, {repeat} times")
+        assert scan() == list(storage.available(WaterCompany.Anglian, since))
+        before = timeit.timeit(scan, number=repeat) / repeat
+        after = timeit.timeit(lambda: list(storage.available(WaterCompany.Anglian, since)), number=repeat) / repeat
+        print(f"{'scan all keys':>24}: {before * 1000:8.2f} ms")
+        print(f"{'catalogue':>24}: {after * 1000:8.2f} ms")
+
+
+def benchmark_codec(texts: List[str], dictionary_size: int, repeat: int):
+    # train on all but the last, as stream-train-dictionary.py would on the files before
+    training = [''.join(lines[i:i + 100]).encode() for text in texts[:-1]
+                for lines in [text.splitlines(keepends=True)] for i in range(0, len(lines), 100)]
+    dictionary = zstd.train_dictionary(dictionary_size, training)
+    data = texts[-1].encode()
+
+    codecs = [
+        ("gzip", lambda d: gzip.compress(d), gzip.decompress),
+        ("zstd", zstd.ZstdCompressor(level=9).compress, zstd.ZstdDecompressor().decompress),
+        ("zstd + dictionary", zstd.ZstdCompressor(level=9, dict_data=dictionary).compress,
+         zstd.ZstdDecompressor(dict_data=dictionary).decompress),
+    ]
+
+    print(f"{len(data)} bytes, dictionary of {len(dictionary.as_bytes())} bytes from {len(training)} samples")
+    for name, compress, decompress in codecs:
+        compressed = compress(data)
+        seconds = timeit.timeit(lambda: decompress(compressed), number=repeat) / repeat
+        print(f"{name:>24}: {len(compressed):10} bytes {len(data) / len(compressed):6.1f}x "
+              f"{seconds * 1000:8.2f} ms decompress")
+
+def benchmark_insert(db_host: str, count: int, batch_sizes: List[int]):
+    # imported here so the other benchmarks don't need psycopg
+    import psy
+    from streamdb import Database, StreamEvent
+
+    records = [replace(r, id=f"BENCH{n:06}") for n, r in enumerate(synthetic_records(count))]
+
+    def row_at_a_time(database: Database, events: List[StreamEvent], features: List[FeatureRecord]):
+        # as insert_cso_events and insert_cso were
+        with database.connection.cursor() as cursor:
+            for event in events:
+                cursor.execute("""
+                               insert into stream_cso_event (stream_cso_id, event_time, event, file_id, update_time)
+                               values (%(cso_id)s, %(event_time)s, %(event)s, %(file_id)s, %(update_time)s)
+                               """, {"cso_id": event.cso_id, "event_time": event.event_time, "event": event.event.name,
+                                     "file_id": event.file_id, "update_time": event.update_time})
+            for feature in features:
+                cursor.execute("""
+                               insert into stream_cso (stream_company, stream_id, lat, lon, point)
+                               VALUES (%(company)s, %(id)s, %(lat)s, %(lon)s,
+                                       st_setsrid(st_makepoint(%(lon)s, %(lat)s), 4326)) on conflict (stream_company, stream_id) do nothing
+                               """, {"company": WaterCompany.Northumbrian.name, "id": feature.id, "lat": feature.lat,
+                                     "lon": feature.lon})
+
+    def copied(database: Database, events: List[StreamEvent], features: List[FeatureRecord]):
+        database.insert_cso_events(events)
+        database.insert_cso(WaterCompany.Northumbrian, features)
+
+    print(f"Inserting {count} events and new CSOs, rolled back after each run")
+
+    pool = psy.connect(db_host)
+    candidates = [("row at a time", row_at_a_time, 1)] + [(f"copy, batches of {b}", copied, b) for b in batch_sizes]
+    for name, insert, batch_size in candidates:
+        with pool.connection() as conn:
+            database = Database(conn, batch_size=batch_size)
+            file = database.create_file(WaterCompany.Northumbrian, datetime.datetime(1970, 1, 1, tzinfo=datetime.UTC))
+            events = [StreamEvent(cso_id=str(uuid.uuid4()), event=EventType.Start, event_time=r.statusStart,
+                                  file_id=file.file_id, update_time=r.lastUpdated) for r in records]
+            start = time.perf_counter()
+            insert(database, events, records)
+            report(name, time.perf_counter() - start, count, 1)
+            conn.rollback()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the stream download/storage path")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    convert = subparsers.add_parser("convert", help="feature conversion: per record vs compiled converter")
+    convert.add_argument("--recording", help="a saved arcgis query response (f=json) (default: synthetic)")
+    convert.add_argument("--count", type=int, default=10_000, help="synthetic features (default: 10000)")
+    convert.add_argument("--repeat", type=int, default=10)
+
+    pbf = subparsers.add_parser("pbf", help="bytes transferred and decode time for f=json vs f=pbf (live service)")
+    pbf.add_argument("--company", type=enum_parser(WaterCompany), default=WaterCompany.ThamesWater)
+    pbf.add_argument("--batches", type=int, default=5, help="number of batches to fetch (default: 5)")
+    pbf.add_argument("--repeat", type=int, default=10)
+
+    download = subparsers.add_parser("download", help="StreamAPI/DwrCymruAPI against the recorded-response stand-in")
+    download.add_argument("--recordings", help="directory of recordings (see standin.py) (default: synthetic)")
+    download.add_argument("--count", type=int, default=50_000, help="synthetic features (default: 50000)")
+    download.add_argument("--latency", type=float, default=0.05, help="seconds added to each request")
+    download.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that fail with a 503")
+    download.add_argument("--workers", type=int, default=1)
+    download.add_argument("--batch-size", type=int, help="(default: the layer's maxRecordCount)")
+    download.add_argument("--stream", action="store_true", help="consume features as they arrive, not as a list")
+
+    load = subparsers.add_parser("csv", help="loading a snapshot: DictReader + per cell reflection vs compiled vs parquet")
+    load.add_argument("--count", type=int, default=10_000, help="synthetic records (default: 10000)")
+    load.add_argument("--repeat", type=int, default=10)
+
+    dates = subparsers.add_parser("dates", help="memory retained by the datetime parse cache over a replay")
+    dates.add_argument("--files", type=int, default=10_000)
+    dates.add_argument("--rows", type=int, default=500)
+
+    available = subparsers.add_parser("available", help="SqlliteStorage.available: scanning keys vs the catalogue")
+    available.add_argument("--files", type=int, default=50_000)
+    available.add_argument("--repeat", type=int, default=10)
+
+    codec = subparsers.add_parser("codec", help="snapshot size and decompression time: gzip vs zstd vs zstd + dictionary")
+    codec.add_argument("--recordings", nargs="+", help="saved snapshot csv files, oldest first (default: synthetic)")
+    codec.add_argument("--count", type=int, default=10_000, help="synthetic records per file (default: 10000)")
+    codec.add_argument("--size", type=int, default=112_640, help="dictionary size (default: 112640)")
+    codec.add_argument("--repeat", type=int, default=10)
+
+    insert = subparsers.add_parser("insert", help="Database.insert_cso_events/insert_cso: row at a time vs copy (needs a db)")
+    insert.add_argument("--db-host", default="localhost")
+    insert.add_argument("--count", type=int, default=20_000, help="events and new CSOs (default: 20000)")
+    insert.add_argument("--batch-size", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+
+    args = parser.parse_args()
+
+    match args.command:
+        case "convert":
+            features = recorded_features(args.recording) if args.recording else synthetic_features(args.count)
+            benchmark_convert(features, args.repeat)
+        case "pbf":
+            benchmark_pbf(args.company, args.batches, args.repeat)
+        case "download":
+            recordings = load_recordings(args.recordings) if args.recordings else synthetic_recordings(args.count)
+            benchmark_download(recordings, args.latency, args.error_rate, args.workers, args.batch_size, args.stream)
+        case "csv":
+            benchmark_csv(args.count, args.repeat)
+        case "dates":
+            benchmark_dates(args.files, args.rows)
+        case "available":
+            benchmark_available(args.files, args.repeat)
+        case "codec":
+            if args.recordings:
+                texts = []
+                for path in args.recordings:
+                    with open(path) as f:
+                        texts.append(f.read())
+            else:
+                texts = [StreamCSV().to_csv(synthetic_records(args.count)) for _ in range(4)]
+            benchmark_codec(texts, args.size, args.repeat)
+        case "insert":
+            benchmark_insert(args.db_host, args.count, args.batch_size)
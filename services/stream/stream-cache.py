@@ -0,0 +1,31 @@
+import argparse
+
+from storage import SqlliteStorage
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="The local snapshot cache (~/.totp/b2-stream-cache.sqlite)")
+    parser.add_argument("--filename", help="cache file (default: ~/.totp/b2-stream-cache.sqlite)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("stats", help="size, hit rate and what's cached for each company")
+
+    evict = subparsers.add_parser("evict", help="evict least recently used files down to a size")
+    evict.add_argument("--max-mb", type=int, required=True)
+
+    args = parser.parse_args()
+
+    match args.command:
+        case "stats":
+            stats = SqlliteStorage(delegate=None, filename=args.filename).stats()
+            hit_rate = "-" if stats['hit_rate'] is None else f"{stats['hit_rate']:.1%}"
+            print(f"{stats['files']} files, {stats['bytes'] / 1024 / 1024:.1f}MiB")
+            print(f"hits {stats.get('hits', 0)}, misses {stats.get('misses', 0)} ({hit_rate}), "
+                  f"puts {stats.get('puts', 0)}, evictions {stats.get('evictions', 0)}")
+            for c in stats['companies']:
+                print(f"{c['company']:>20}: {c['files']:7} files {c['bytes'] / 1024 / 1024:9.1f}MiB "
+                      f"{c['oldest']:%Y-%m-%d %H:%M} - {c['newest']:%Y-%m-%d %H:%M}")
+        case "evict":
+            storage = SqlliteStorage(delegate=None, filename=args.filename, max_bytes=args.max_mb * 1024 * 1024)
+            before = storage.size
+            storage.evict()
+            print(f"{before / 1024 / 1024:.1f}MiB -> {storage.size / 1024 / 1024:.1f}MiB")
@@ -0,0 +1,47 @@
+import argparse
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from args import enum_parser
+from companies import WaterCompany, StreamMembers
+from secret import env
+from storage import b2_service, garage_service, S3Storage
+
+
+# Packs each finished day's snapshot files for a company into one bundle object, so backfills fetch a day at a time.
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack each day's stream snapshots into a single bundle object")
+    parser.add_argument("--company", type=enum_parser(WaterCompany), nargs="+",
+                        help="company (default: all, including DwrCymru)")
+    parser.add_argument("--since", type=datetime.date.fromisoformat, default=datetime.date(2024, 12, 1))
+    parser.add_argument("--garage", action="store_true")
+    parser.add_argument("--delete", action="store_true", help="delete the files once they're in the bundle")
+    parser.add_argument("--workers", type=int, default=4, help="days to compact at once (default: 4)")
+
+    args = parser.parse_args()
+
+    if args.garage:
+        s3 = garage_service(
+            env("GARAGE_ACCESS_KEY_ID", "garage_key_id"),
+            env("GARAGE_SECRET_ACCESS_KEY", "garage_secret_key")
+        )
+        bucket = s3.Bucket(env("GARAGE_BUCKET_NAME", "garage_bucket_name"))
+    else:
+        s3 = b2_service(
+            env("AWS_ACCESS_KEY_ID", "s3_key_id"),
+            env("AWS_SECRET_ACCESS_KEY", "s3_secret_key")
+        )
+        bucket = s3.Bucket(env("STREAM_BUCKET_NAME", "stream_bucket_name"))
+
+    companies = args.company or StreamMembers + [WaterCompany.DwrCymru]
+    today = datetime.datetime.now(tz=datetime.UTC).date()
+    days = [args.since + datetime.timedelta(days=d) for d in range((today - args.since).days)]
+
+    s3_storage = S3Storage(bucket)
+
+    for company in companies:
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            packed = sum(executor.map(lambda day: s3_storage.compact(company, day, delete=args.delete), days))
+
+        print(f"{company}: packed {packed} files from {len(days)} days")
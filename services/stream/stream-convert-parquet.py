@@ -0,0 +1,67 @@
+import argparse
+import datetime
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from args import enum_parser
+from companies import WaterCompany, StreamMembers
+from secret import env
+from storage import b2_service, garage_service, S3Storage, CSVFileStorage, StreamParquet, DwrCymruParquet, \
+    ParquetFile
+
+
+# One-off: write a parquet copy alongside each historic csv.gz snapshot. The csv files are left where they are.
+
+def convert(s3: S3Storage, storage: CSVFileStorage, parquet: ParquetFile, company: WaterCompany,
+            dt: datetime.datetime) -> bool:
+    # an unchanged snapshot is read from the one it refers to, which gets its own parquet
+    if s3.exists(company, dt, parquet.suffix) or storage.reference(company, dt) is not None:
+        return False
+    items = storage.load(company, dt)
+    with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as spool:
+        parquet.write(items, spool)
+        spool.seek(0)
+        s3.save_blob(company, dt, parquet.suffix, spool)
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write parquet copies of the csv.gz stream snapshots")
+    parser.add_argument("--company", type=enum_parser(WaterCompany), nargs="+",
+                        help="company (default: all, including DwrCymru)")
+    parser.add_argument("--since", type=datetime.date.fromisoformat, default=datetime.date(2024, 12, 1))
+    parser.add_argument("--garage", action="store_true")
+    parser.add_argument("--bundle-reads", choices=["whole", "range"], default="whole",
+                        help="read a compacted day's bundle in one go, or each file with a range request (default: whole)")
+    parser.add_argument("--workers", type=int, default=4, help="files to convert at once (default: 4)")
+
+    args = parser.parse_args()
+
+    if args.garage:
+        s3 = garage_service(
+            env("GARAGE_ACCESS_KEY_ID", "garage_key_id"),
+            env("GARAGE_SECRET_ACCESS_KEY", "garage_secret_key")
+        )
+        bucket = s3.Bucket(env("GARAGE_BUCKET_NAME", "garage_bucket_name"))
+    else:
+        s3 = b2_service(
+            env("AWS_ACCESS_KEY_ID", "s3_key_id"),
+            env("AWS_SECRET_ACCESS_KEY", "s3_secret_key")
+        )
+        bucket = s3.Bucket(env("STREAM_BUCKET_NAME", "stream_bucket_name"))
+
+    companies = args.company or StreamMembers + [WaterCompany.DwrCymru]
+    since = datetime.datetime.combine(args.since, datetime.time.min, tzinfo=datetime.UTC)
+
+    # straight to the bucket - the history shouldn't all end up in the local cache
+    s3_storage = S3Storage(bucket, bundle_reads=args.bundle_reads)
+
+    for company in companies:
+        parquet = DwrCymruParquet() if company == WaterCompany.DwrCymru else StreamParquet()
+        storage = CSVFileStorage(s3_storage, parquet.csvfile)
+
+        available = list(s3_storage.available(company, since=since))
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            converted = sum(executor.map(lambda dt: convert(s3_storage, storage, parquet, company, dt), available))
+
+        print(f"{company}: converted {converted} of {len(available)} files")
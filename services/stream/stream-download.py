@@ -1,17 +1,72 @@
 import argparse
 import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterable, TypeVar, Iterator, Tuple
 
 from args import enum_parser
 from companies import StreamMembers
 from companies import WaterCompany
 from secret import env
-from storage import b2_service, CSVFileStorage, SqlliteStorage, StreamCSV, S3Storage
+from storage import b2_service, CSVFileStorage, SqlliteStorage, StreamCSV, S3Storage, StreamParquet, ZstdCodec
 from stream import StreamAPI
 
+T = TypeVar('T')
+
+
+class Counted[T]:
+    def __init__(self, items: Iterable[T]):
+        self.items = items
+        self.count = 0
+
+    def __iter__(self) -> Iterator[T]:
+        for item in self.items:
+            self.count += 1
+            yield item
+
+
+def download(storage: CSVFileStorage, company: WaterCompany, delta: bool, workers: int, pbf: bool) -> int:
+    print(f"Loading {company}")
+    now = datetime.datetime.now(tz=datetime.UTC)
+    api = StreamAPI(company=company, max_workers=workers, pbf=pbf)
+
+    features = None
+    if delta:
+        previous = storage.latest(company=company, since=now - datetime.timedelta(hours=6))
+        if previous is not None:
+            print(f">>> {company}: Fetching changes since snapshot at {previous[0]}")
+            features = api.delta_features(previous[1])
+
+    if features is None:
+        counted = Counted(api.iter_features())
+        storage.save_iter(company=company, dt=now, items=counted)
+        return counted.count
+
+    storage.save(company=company, dt=now, items=features)
+    return len(features)
+
+
+def timed_download(storage: CSVFileStorage, company: WaterCompany, **kwargs) -> Tuple[int, float]:
+    start = time.perf_counter()
+    count = download(storage, company, **kwargs)
+    return count, time.perf_counter() - start
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description="Download current status from horrible stream api")
     parser.add_argument("--company", type=enum_parser(WaterCompany), nargs="+", help="company (default: all)")
+    parser.add_argument("--delta", action="store_true", help="only fetch features updated since the last snapshot")
+    parser.add_argument("--pbf", action="store_true", help="fetch features as protobuf where the service supports it")
+    parser.add_argument("--workers", type=int, default=4, help="concurrent batch requests per company (default: 4)")
+    parser.add_argument("--parallel", type=int, default=1, help="companies to download at once (default: 1)")
+    parser.add_argument("--parquet", action="store_true", help="also save each snapshot as parquet")
+    parser.add_argument("--delta-storage", action="store_true",
+                        help="save snapshots as changes from a periodic full one (not --delta, which is what to download)")
+    parser.add_argument("--keyframe-hours", type=float, default=24, help="hours between full snapshots (default: 24)")
+    parser.add_argument("--dedupe", action="store_true", help="save an unchanged snapshot as a reference to the last one")
+    parser.add_argument("--zstd", action="store_true", help="save snapshots with zstd, and the company's dictionary")
+    parser.add_argument("--cache-mb", type=int, default=2048, help="local snapshot cache size (default: 2048)")
 
     args = parser.parse_args()
 
@@ -26,13 +81,38 @@ if __name__ == "__main__":
     )
     bucket = s3.Bucket(env("STREAM_BUCKET_NAME", "stream_bucket_name"))
 
+    cache = SqlliteStorage(delegate=S3Storage(bucket), max_bytes=args.cache_mb * 1024 * 1024)
     storage = CSVFileStorage(
-        SqlliteStorage(delegate=S3Storage(bucket)),
-        StreamCSV()
+        cache,
+        StreamCSV(),
+        parquet=StreamParquet() if args.parquet else None,
+        write_parquet=args.parquet,
+        deltas=args.delta_storage,
+        keyframe_interval=datetime.timedelta(hours=args.keyframe_hours),
+        dedupe=args.dedupe,
+        codec=ZstdCodec(cache) if args.zstd else None
     )
 
-    for company in companies:
-        print(f"Loading {company}")
-        api = StreamAPI(company=company)
-        features = api.features()
-        storage.save(company=company, dt=datetime.datetime.now(), items=features)
+    start = time.perf_counter()
+    failed = []
+
+    # each company saves its own snapshot as soon as it has it
+    with ThreadPoolExecutor(max_workers=args.parallel) as executor:
+        futures = {
+            executor.submit(timed_download, storage, company, delta=args.delta, workers=args.workers, pbf=args.pbf): company
+            for company in companies
+        }
+
+        for future in as_completed(futures):
+            company = futures[future]
+            try:
+                count, seconds = future.result()
+                print(f"{company}: {count} features in {seconds:.1f}s")
+            except Exception as e:
+                print(f"{company}: FAILED {e!r}")
+                failed.append(company)
+
+    print(f"Downloaded {len(companies) - len(failed)}/{len(companies)} companies in {time.perf_counter() - start:.1f}s")
+
+    if failed:
+        raise SystemExit(f"Failed: {', '.join(c.name for c in failed)}")
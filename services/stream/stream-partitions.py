@@ -0,0 +1,96 @@
+import argparse
+import datetime
+import gzip
+import os
+import tempfile
+
+import psy
+from secret import env
+from storage import b2_service, garage_service
+from streamdb import Database, PARTITIONED, partition_name, months_to
+
+# stream_file_events and stream_file_content are partitioned by month, so queries bounded by file_time only look at
+# the months they need. 'create' runs from cron (entrypoint.sh) so each month's partitions are there before it starts -
+# rows that arrive before then go to the default partition, and are moved out when their month is created. It only
+# fills in from the earliest attached month, so a month that's been rolled up isn't created again.
+# 'migrate' also runs from cron, before 'create', and does nothing once it's been done.
+# 'rollup' archives old months to the bucket as csv.gz and detaches them.
+#
+# The state tables (see stream-state.py) aren't affected by a rollup, but a rebuild only sees what's still attached.
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Manage the monthly partitions of the stream content tables")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    migrate = subparsers.add_parser("migrate", help="replace the unpartitioned tables with partitioned ones (if they aren't already)")
+    migrate.add_argument("--table", choices=PARTITIONED, nargs="+", help="(default: both)")
+    migrate.add_argument("--ahead", type=int, default=3, help="months to create ahead (default: 3)")
+
+    create = subparsers.add_parser("create", help="create partitions from the earliest attached one to some months ahead")
+    create.add_argument("--ahead", type=int, default=3, help="months to create ahead (default: 3)")
+
+    rollup = subparsers.add_parser("rollup", help="archive months before a date to the bucket, and detach them")
+    rollup.add_argument("--before", type=datetime.date.fromisoformat, required=True)
+    rollup.add_argument("--table", choices=PARTITIONED, nargs="+", help="(default: both)")
+    rollup.add_argument("--garage", action="store_true")
+    rollup.add_argument("--drop", action="store_true", help="drop the partitions once detached")
+
+    args = parser.parse_args()
+
+    db_host = os.environ.get("DB_HOST", "localhost")
+
+    pool = psy.connect(db_host)
+
+    with pool.connection() as conn:
+        database = Database(conn)
+
+        match args.command:
+            case "migrate":
+                for table in args.table or PARTITIONED:
+                    if database.partitioned(table):
+                        print(f"{table}: already partitioned")
+                        continue
+                    count = database.partition_table(table, ahead=args.ahead)
+                    conn.commit()
+                    print(f"{table}: partitioned, {count} rows copied")
+
+            case "create":
+                for table in PARTITIONED:
+                    # only from the earliest month still attached - anything before that has been rolled up
+                    attached = database.partitions(table)
+                    first = attached[0] if attached else datetime.date.today()
+                    created = database.create_partitions(table, months_to(first, ahead=args.ahead))
+                    conn.commit()
+                    print(f"{table}: created {created}")
+
+            case "rollup":
+                if args.garage:
+                    s3 = garage_service(
+                        env("GARAGE_ACCESS_KEY_ID", "garage_key_id"),
+                        env("GARAGE_SECRET_ACCESS_KEY", "garage_secret_key")
+                    )
+                    bucket = s3.Bucket(env("GARAGE_BUCKET_NAME", "garage_bucket_name"))
+                else:
+                    s3 = b2_service(
+                        env("AWS_ACCESS_KEY_ID", "s3_key_id"),
+                        env("AWS_SECRET_ACCESS_KEY", "s3_secret_key")
+                    )
+                    bucket = s3.Bucket(env("STREAM_BUCKET_NAME", "stream_bucket_name"))
+                client = bucket.meta.client
+
+                for table in args.table or PARTITIONED:
+                    for month in [m for m in database.partitions(table) if m < args.before.replace(day=1)]:
+                        key = f"archive/{table}/{partition_name(table, month)}.csv.gz"
+                        with tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024) as spool:
+                            with gzip.GzipFile(fileobj=spool, mode="wb") as gz:
+                                database.copy_partition(table, month, gz)
+                            size = spool.tell()
+                            spool.seek(0)
+                            client.upload_fileobj(spool, bucket.name, key)
+                        # only let go of the rows once the archive is there
+                        if client.head_object(Bucket=bucket.name, Key=key)["ContentLength"] != size:
+                            raise SystemExit(f"{key}: archive doesn't match what was written")
+                        database.detach_partition(table, month, drop=args.drop)
+                        conn.commit()
+                        print(f"{table}: {month:%Y-%m} archived to {key} ({size} bytes){' and dropped' if args.drop else ''}")
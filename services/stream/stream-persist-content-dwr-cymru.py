@@ -11,7 +11,7 @@ import logging
 import psy
 from secret import env
 from companies import WaterCompany
-from storage import DwrCymruCSV, garage_service
+from storage import DwrCymruCSV, garage_service, DwrCymruParquet
 from stream import DwrCymruRecord
 from storage import b2_service, CSVFileStorage, SqlliteStorage, S3Storage
 from stream import FeatureRecord, EventType
@@ -47,6 +47,13 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description="Attempt to parse events from stream status files - DwyCymru")
     parser.add_argument("--garage", action="store_true")
+    parser.add_argument("--bundle-reads", choices=["whole", "range"], default="whole",
+                        help="read a compacted day's bundle in one go, or each file with a range request (default: whole)")
+    parser.add_argument("--parquet", action="store_true", help="read parquet snapshots where there are any")
+    parser.add_argument("--skip-unchanged", action="store_true",
+                        help="skip snapshots saved as references to an earlier one (see stream-download.py --dedupe)")
+    parser.add_argument("--cache-mb", type=int, default=2048, help="local snapshot cache size (default: 2048)")
+    parser.add_argument("--prefetch", type=int, default=4, help="snapshots to load ahead of the database (default: 4)")
     args = parser.parse_args()
 
     if args.garage:
@@ -62,9 +69,11 @@ if __name__ == '__main__':
         )
         bucket = s3.Bucket(env("STREAM_BUCKET_NAME", "stream_bucket_name"))
 
+    cache = SqlliteStorage(delegate=S3Storage(bucket, bundle_reads=args.bundle_reads), max_bytes=args.cache_mb * 1024 * 1024)
     storage = CSVFileStorage(
-        SqlliteStorage(delegate=S3Storage(bucket)),
-        DwrCymruCSV()
+        cache,
+        DwrCymruCSV(),
+        parquet=DwrCymruParquet() if args.parquet else None
     )
 
     db_host = os.environ.get("DB_HOST", "localhost")
@@ -94,13 +103,12 @@ if __name__ == '__main__':
         most_recent = database.most_recent_records(company=company)
         most_recent_by_id = {x.id: x for x in most_recent}
 
-        for ts in storage.available(company=company, since=since):
+        for ts, features in storage.load_ahead(company, storage.available(company=company, since=since),
+                                               ahead=args.prefetch, skip_references=args.skip_unchanged):
             print(f"Need to process: {company}: {ts}")
 
             file_ref = database.create_file(company=company, file_time=ts)
 
-            features = storage.load(company, ts)
-
             logger.info(f"File {file_ref.company} {file_ref.file_id}- Records in file {len(features)}, valid {len(features)}")
 
             ## Now we need to filter out any duplicates
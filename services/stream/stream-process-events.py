@@ -28,15 +28,16 @@ logger = logging.getLogger(__name__)
 
 class EventProcessor:
 
-    def __init__(self, pool: ConnectionPool, feature_filter: Callable[[FeatureRecord], bool]):
+    def __init__(self, pool: ConnectionPool, feature_filter: Callable[[FeatureRecord], bool], batch_size: int = 10_000):
         self.pool = pool
         self.feature_filter = feature_filter
+        self.batch_size = batch_size
 
     def process_events(self, company: WaterCompany) -> bool:
 
         with self.pool.connection() as conn:
 
-            database = Database(conn)
+            database = Database(conn, batch_size=self.batch_size)
 
             ids = database.load_ids(company)
 
@@ -96,6 +97,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Attempt to parse events from stream status files")
     parser.add_argument("--company", type=enum_parser(WaterCompany), nargs="+", help="company (default: all)")
     parser.add_argument("--id", help="id (default: all)")
+    parser.add_argument("--batch-size", type=int, default=10_000, help="rows per copy into the database (default: 10000)")
 
     args = parser.parse_args()
 
@@ -115,7 +117,7 @@ if __name__ == '__main__':
 
     pool = psy.connect(db_host)
 
-    event_processor = EventProcessor(pool, feature_filter)
+    event_processor = EventProcessor(pool, feature_filter, batch_size=args.batch_size)
 
     with ThreadPoolExecutor(max_workers=8) as executor:
         futures = [executor.submit(event_processor.process_events, company) for company in companies]
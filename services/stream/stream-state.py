@@ -0,0 +1,89 @@
+import argparse
+import os
+
+import psy
+from args import enum_parser
+from companies import WaterCompany
+from streamdb import Database
+
+# The state tables kept up to date as rows are inserted, so the cron jobs needn't scan the whole history.
+# rebuild recreates them from the history - after a schema change, or anything written around Database - and
+# check lists the ids where they disagree with it.
+#
+# fill rebuilds only the tables a company has no rows in yet. It runs from cron (entrypoint.sh) before anything is
+# loaded, so on a database that had history before the state tables existed they're filled from it - otherwise the
+# readers would see nothing for every cso, and the new loads would only fill in the ones they touch.
+
+TABLES = {
+    "latest-events": Database.rebuild_cso_latest,
+    "latest-records": Database.rebuild_file_events_latest,
+    "last-seen": Database.rebuild_cso_last_seen,
+    "watermark": Database.rebuild_watermark,
+}
+
+FILLED = {
+    "latest-events": Database.has_cso_latest,
+    "latest-records": Database.has_file_events_latest,
+    "last-seen": Database.has_cso_last_seen,
+    "watermark": Database.has_watermark,
+}
+
+CHECKS = {
+    "latest-events": Database.check_cso_latest,
+    "latest-records": Database.check_file_events_latest,
+    "last-seen": Database.check_cso_last_seen,
+    "watermark": Database.check_watermark,
+}
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Rebuild or check the stream state tables against the history")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    rebuild = subparsers.add_parser("rebuild", help="recreate state tables from the history")
+    rebuild.add_argument("--company", type=enum_parser(WaterCompany), nargs="+", help="company (default: all)")
+    rebuild.add_argument("--table", choices=list(TABLES), nargs="+", help="(default: all)")
+
+    fill = subparsers.add_parser("fill", help="rebuild state tables the company has no rows in yet")
+    fill.add_argument("--company", type=enum_parser(WaterCompany), nargs="+", help="company (default: all)")
+    fill.add_argument("--table", choices=list(FILLED), nargs="+", help="(default: all)")
+
+    check = subparsers.add_parser("check", help="compare state tables with the history")
+    check.add_argument("--company", type=enum_parser(WaterCompany), nargs="+", help="company (default: all)")
+    check.add_argument("--table", choices=list(CHECKS), nargs="+", help="(default: all)")
+
+    args = parser.parse_args()
+
+    db_host = os.environ.get("DB_HOST", "localhost")
+
+    companies = args.company or list(WaterCompany)
+
+    pool = psy.connect(db_host)
+
+    with pool.connection() as conn:
+        database = Database(conn)
+
+        match args.command:
+            case "rebuild":
+                for table in args.table or list(TABLES):
+                    for company in companies:
+                        count = TABLES[table](database, company)
+                        conn.commit()
+                        print(f"{company}: {table} rebuilt, {count} rows")
+            case "fill":
+                for table in args.table or list(FILLED):
+                    for company in companies:
+                        if FILLED[table](database, company):
+                            continue
+                        count = TABLES[table](database, company)
+                        conn.commit()
+                        print(f"{company}: {table} filled, {count} rows")
+            case "check":
+                inconsistent = False
+                for table in args.table or list(CHECKS):
+                    for company in companies:
+                        wrong = CHECKS[table](database, company)
+                        inconsistent = inconsistent or bool(wrong)
+                        print(f"{company}: {table} {len(wrong)} inconsistent {wrong[:10] if wrong else ''}")
+                if inconsistent:
+                    raise SystemExit("State tables don't match the history - rebuild them")
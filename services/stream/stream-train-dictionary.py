@@ -0,0 +1,66 @@
+import argparse
+import datetime
+
+import zstandard as zstd
+
+from args import enum_parser
+from companies import WaterCompany, StreamMembers
+from secret import env
+from storage import b2_service, garage_service, S3Storage, SqlliteStorage, CSVFileStorage, StreamCSV, DwrCymruCSV
+
+
+# Trains a zstd dictionary for each company from its recent snapshots, for ZstdCodec to compress new ones with.
+# Files are cut into runs of rows to train on - the dictionary is meant to capture what rows have in common.
+
+def samples(text: str, rows: int) -> list[bytes]:
+    lines = text.splitlines(keepends=True)
+    return [''.join(lines[i:i + rows]).encode() for i in range(0, len(lines), rows)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train per-company zstd dictionaries for snapshot compression")
+    parser.add_argument("--company", type=enum_parser(WaterCompany), nargs="+",
+                        help="company (default: all, including DwrCymru)")
+    parser.add_argument("--files", type=int, default=96, help="most recent snapshots to train on (default: 96)")
+    parser.add_argument("--rows", type=int, default=100, help="rows per training sample (default: 100)")
+    parser.add_argument("--size", type=int, default=112_640, help="dictionary size in bytes (default: 112640)")
+    parser.add_argument("--garage", action="store_true")
+
+    args = parser.parse_args()
+
+    if args.garage:
+        s3 = garage_service(
+            env("GARAGE_ACCESS_KEY_ID", "garage_key_id"),
+            env("GARAGE_SECRET_ACCESS_KEY", "garage_secret_key")
+        )
+        bucket = s3.Bucket(env("GARAGE_BUCKET_NAME", "garage_bucket_name"))
+    else:
+        s3 = b2_service(
+            env("AWS_ACCESS_KEY_ID", "s3_key_id"),
+            env("AWS_SECRET_ACCESS_KEY", "s3_secret_key")
+        )
+        bucket = s3.Bucket(env("STREAM_BUCKET_NAME", "stream_bucket_name"))
+
+    storage = SqlliteStorage(delegate=S3Storage(bucket))
+    companies = args.company or StreamMembers + [WaterCompany.DwrCymru]
+    since = datetime.datetime.now(tz=datetime.UTC) - datetime.timedelta(days=7)
+
+    for company in companies:
+        csvfile = DwrCymruCSV() if company == WaterCompany.DwrCymru else StreamCSV()
+        snapshots = CSVFileStorage(storage, csvfile)
+
+        recent = list(snapshots.available(company, since=since))[-args.files:]
+        training = [sample for dt in recent for sample in samples(csvfile.to_csv(snapshots.load(company, dt)), args.rows)]
+        if not training:
+            print(f"{company}: no snapshots since {since}")
+            continue
+
+        dictionary = zstd.train_dictionary(args.size, training)
+        content = dictionary.as_bytes()
+        storage.save_dictionary(company, dictionary.dict_id(), content)
+
+        text = csvfile.to_csv(snapshots.load(company, recent[-1]))
+        plain = len(zstd.ZstdCompressor(level=9).compress(text.encode()))
+        trained = len(zstd.ZstdCompressor(level=9, dict_data=dictionary).compress(text.encode()))
+        print(f"{company}: dictionary {dictionary.dict_id()} ({len(content)} bytes) from {len(recent)} files - "
+              f"latest is {len(text)} bytes, {plain} with zstd, {trained} with the dictionary")
@@ -2,15 +2,22 @@ import collections
 import dataclasses
 import datetime
 import itertools
+import operator
+import os
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-from typing import List, Dict, Optional, TypeVar, Callable
+from typing import List, Dict, Optional, TypeVar, Iterator, Iterable, Tuple
 
 import requests
 from requests.adapters import HTTPAdapter
 from requests.structures import CaseInsensitiveDict
+from sqlitedict import SqliteDict
 from urllib3 import Retry
 from hashlib import sha256
 
+from arcgis_pbf import decode_feature_query, PbfError
 from companies import WaterCompany
 
 T = TypeVar('T')
@@ -144,6 +151,19 @@ class FeatureList:
     ids: List[int]
 
 
+@dataclasses.dataclass(frozen=True)
+class LayerInfo:
+    max_record_count: int
+    query_formats: List[str]
+    fetched: datetime.datetime
+
+
+def layer_cache() -> SqliteDict:
+    totp = os.path.expanduser("~/.totp")
+    os.makedirs(totp, exist_ok=True)
+    return SqliteDict(filename=str(os.path.join(totp, "arcgis-layers.sqlite")), autocommit=True)
+
+
 def timestamp(epoch_ms: Optional[int]) -> Optional[datetime.datetime]:
     return datetime.datetime.fromtimestamp(epoch_ms / 1000.0, tz=datetime.UTC)
 
@@ -155,6 +175,17 @@ def timestamp_optional(epoch_ms: Optional[int]) -> Optional[datetime.datetime]:
     return timestamp(epoch_ms)
 
 
+def timestamps_optional(epoch_ms: Iterable[Optional[int]]) -> List[Optional[datetime.datetime]]:
+    # a column at a time - in a batch most features share the same handful of update times
+    converted = {}
+    result = []
+    for v in epoch_ms:
+        if v not in converted:
+            converted[v] = timestamp_optional(v)
+        result.append(converted[v])
+    return result
+
+
 def iso_datetime_optional(s: Optional[str]) -> Optional[datetime.datetime]:
     if s is None:
         return None
@@ -169,17 +200,105 @@ def float_string_optional(s: Optional[str]) -> Optional[float]:
     return float(s)
 
 
+# several companies share an arcgis host (e.g. services-eu1), so the limit is per host, not per server
+# - the first server for a host sets its limit, and any other asked for is reported and ignored
+_host_limits: Dict[str, Tuple[int, threading.BoundedSemaphore]] = {}
+_host_limits_lock = threading.Lock()
+
+
+def host_limit(uri: str, limit: int) -> threading.BoundedSemaphore:
+    host = urllib.parse.urlsplit(uri).netloc
+    with _host_limits_lock:
+        if host not in _host_limits:
+            _host_limits[host] = (limit, threading.BoundedSemaphore(limit))
+        existing, semaphore = _host_limits[host]
+        if existing != limit:
+            print(f">>> {host} is already limited to {existing} requests at once, not {limit}")
+        return semaphore
+
+
+# beyond this the object ids go in a POST body - some servers/proxies reject long urls
+MAX_URL_LENGTH = 2000
+DEFAULT_BATCH_SIZE = 100
+
+
 class ArcGisFeatureServer[T]:
-    def __init__(self, base_uri: str):
+    def __init__(self, base_uri: str, max_workers: int = 1, max_per_host: int = 4, batch_size: Optional[int] = None,
+                 layer_ttl: datetime.timedelta = datetime.timedelta(days=7), pbf: bool = False):
         self.session = requests.Session()
-        self.session.mount('https://', HTTPAdapter(
-            max_retries=(Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504]))
-        ))
+        adapter = HTTPAdapter(
+            pool_maxsize=max(max_workers, 10),
+            # feature queries are read-only, so it is safe to retry them when POSTed
+            max_retries=(Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504],
+                               allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"}))
+        )
+        self.session.mount('https://', adapter)
+        # the stand-in server for benchmarks is plain http
+        self.session.mount('http://', adapter)
         self.base_uri = base_uri
+        self.layer_uri = base_uri.removesuffix('/query')
+        self.max_workers = max_workers
+        self.host_limit = host_limit(base_uri, max_per_host)
+        self.batch_size = batch_size
+        self.layer_ttl = layer_ttl
+        self.pbf = pbf
+
+    def _fetch_layer(self) -> LayerInfo:
+        response = self.session.get(self.layer_uri, params={'f': 'json'})
+        response.raise_for_status()
+        resp = response.json()
+        if 'error' in resp:
+            raise IOError(f"{self.layer_uri}: {resp['error']}")
+        return LayerInfo(
+            max_record_count=resp.get('maxRecordCount', DEFAULT_BATCH_SIZE),
+            query_formats=[f.strip().lower() for f in resp.get('supportedQueryFormats', 'JSON').split(',')],
+            fetched=datetime.datetime.now(tz=datetime.UTC)
+        )
 
-    def _feature_list(self) -> FeatureList:
+    def _layer(self) -> LayerInfo:
+        # only the real (https) servers are cached - the stand-in is always on the same local address, whatever it's
+        # replaying
+        if urllib.parse.urlparse(self.layer_uri).scheme != 'https':
+            return self._fetch_layer()
+        with layer_cache() as cache:
+            layer = cache.get(self.layer_uri)
+            if layer is None or layer.fetched < datetime.datetime.now(tz=datetime.UTC) - self.layer_ttl:
+                layer = self._fetch_layer()
+                print(f">>> Layer {self.layer_uri} maxRecordCount={layer.max_record_count}")
+                cache[self.layer_uri] = layer
+            return layer
+
+    def _batch_size(self) -> int:
+        if self.batch_size is not None:
+            return self.batch_size
+        try:
+            return self._layer().max_record_count
+        except (requests.RequestException, IOError) as e:
+            print(f">>> Can't get layer info for {self.layer_uri} ({e}), using batches of {DEFAULT_BATCH_SIZE}")
+            return DEFAULT_BATCH_SIZE
+
+    def _query(self, params: Dict) -> requests.Response:
+        url = requests.Request('GET', self.base_uri, params=params).prepare().url
+        if len(url) > MAX_URL_LENGTH:
+            return self.session.post(self.base_uri, data=params)
+        return self.session.get(self.base_uri, params=params)
+
+    def _distinct_count(self, field: str, where: str = '1=1') -> Optional[int]:
+        """how many different values of field there are, or None if the service can't count them"""
         response = self.session.get(self.base_uri, params={
-            'where': '1=1',
+            'where': where,
+            'outFields': field,
+            'returnDistinctValues': 'true',
+            'returnCountOnly': 'true',
+            'f': 'json'
+        })
+        response.raise_for_status()
+        # errors come back as json, with a 200
+        return response.json().get('count')
+
+    def _feature_list(self, where: str = '1=1') -> FeatureList:
+        response = self.session.get(self.base_uri, params={
+            'where': where,
             'outFields': '*',
             'outSR': 4326,
             'f': 'json',
@@ -199,39 +318,142 @@ class ArcGisFeatureServer[T]:
             ids=ids
         )
 
-    def _features(self, convert: Callable[[Dict], T], oids: List[int]) -> List[T]:
+    def _fetch(self, oids: List[int], f: str) -> requests.Response:
         things = ','.join([str(oid) for oid in oids])
-        response = self.session.get(self.base_uri, params={
-            'where': f"1=1",
-            'outFields': '*',
-            'outSR': 4326,
-            'f': 'json',
-            'objectIds': things,
-        })
+        with self.host_limit:
+            response = self._query({
+                'where': f"1=1",
+                'outFields': '*',
+                'outSR': 4326,
+                'f': f,
+                'objectIds': things,
+            })
         response.raise_for_status()
-
-        resp = response.json()
-
-        # northumbrian sometimes doesn't have geometry fields !?!?
-        return [convert(dict(f["attributes"], **f.get("geometry", {'x': 0, 'y': 0}))) for f in resp["features"]]
+        return response
+
+    def _use_pbf(self) -> bool:
+        if not self.pbf:
+            return False
+        try:
+            supported = 'pbf' in self._layer().query_formats
+        except (requests.RequestException, IOError):
+            supported = False
+        if not supported:
+            print(f">>> {self.layer_uri} doesn't support pbf, using json")
+            self.pbf = False
+        return self.pbf
+
+    def _fetch_pbf(self, oids: List[int]) -> Dict:
+        response = self._fetch(oids, 'pbf')
+        # errors come back as json, with a 200
+        if not response.headers.get('Content-Type', '').startswith('application/x-protobuf'):
+            raise PbfError(f"Response is {response.headers.get('Content-Type')}, not protobuf")
+        return decode_feature_query(response.content)
+
+    def _features(self, oids: List[int], pbf: bool = False) -> List[T]:
+        # pbf is whether the layer supports it, looked up once per iter_features - self.pbf is cleared if it fails
+        if pbf and self.pbf:
+            try:
+                return self._convert_features(self._fetch_pbf(oids)["features"])
+            except (requests.HTTPError, PbfError) as e:
+                print(f">>> pbf query failed for {self.layer_uri} ({e}), using json")
+                self.pbf = False
+
+        resp = self._fetch(oids, 'json').json()
+
+        return self._convert_features(resp["features"])
 
     def _convert(self, d: Dict) -> T:
         raise NotImplementedError()
 
+    def _convert_features(self, features: List[Dict]) -> List[T]:
+        # northumbrian sometimes doesn't have geometry fields !?!?
+        return [self._convert(dict(f["attributes"], **f.get("geometry", {'x': 0, 'y': 0}))) for f in features]
+
+    def iter_features(self, where: str = '1=1') -> Iterator[T]:
+        feature_list = self._feature_list(where)
+
+        groups = itertools.batched(feature_list.ids, self._batch_size())
+        pbf = self._use_pbf()
+
+        if self.max_workers > 1:
+            # only keep a few batches in flight, and hand them back in the order they were requested
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                pending = collections.deque()
+                for g in groups:
+                    pending.append(executor.submit(self._features, g, pbf))
+                    if len(pending) >= self.max_workers * 2:
+                        yield from pending.popleft().result()
+                while pending:
+                    yield from pending.popleft().result()
+        else:
+            for g in groups:
+                yield from self._features(g, pbf)
+
     def features(self) -> List[T]:
-        feature_list = self._feature_list()
+        return list(self.iter_features())
+
+
+def high_water_mark(features: Iterable[FeatureRecord]) -> Optional[datetime.datetime]:
+    return max((f.lastUpdated for f in features if f.lastUpdated is not None), default=None)
+
 
-        groups = itertools.batched(feature_list.ids, 100)
+def merge_features(previous: List[FeatureRecord], updates: Iterable[FeatureRecord]) -> List[FeatureRecord]:
+    # updated records replace the previous one in place, new ones go at the end
+    by_id = {f.id: f for f in previous}
+    by_id.update({f.id: f for f in updates})
+    return list(by_id.values())
 
-        return list(itertools.chain.from_iterable(
-            [self._features(self._convert, g) for g in groups]
-        ))
+
+class StreamConverter:
+    """converts stream features using the field names resolved from the first feature a company sends"""
+
+    fields = ("Id", "Status", "StatusStart", "Company", "LastUpdated", "LatestEventStart", "LatestEventEnd",
+              "Latitude", "Longitude", "ReceivingWaterCourse")
+
+    def __init__(self, example: Dict):
+        actual = {k.lower(): k for k in example.keys()}
+        self.getter = operator.itemgetter(*[actual[f.lower()] for f in self.fields])
+
+    def convert(self, attributes: List[Dict]) -> List[FeatureRecord]:
+        rows = [self.getter(a) for a in attributes]
+        if not rows:
+            return []
+
+        (ids, statuses, status_starts, companies, last_updates, latest_starts, latest_ends,
+         lats, lons, receiving_waters) = zip(*rows)
+
+        return [
+            FeatureRecord(
+                id=values[0],
+                status=values[1],
+                statusStart=values[2],
+                company=values[3],
+                lastUpdated=values[4],
+                latestEventStart=values[5],
+                latestEventEnd=values[6],
+                lat=values[7],
+                lon=values[8],
+                receivingWater=values[9],
+            )
+            for values in zip(ids, statuses, timestamps_optional(status_starts), companies,
+                              timestamps_optional(last_updates), timestamps_optional(latest_starts),
+                              timestamps_optional(latest_ends), lats, lons, receiving_waters)
+        ]
 
 
 class StreamAPI(ArcGisFeatureServer[FeatureRecord]):
 
-    def __init__(self, company: WaterCompany):
-        super().__init__(data_urls[company])
+    def __init__(self, company: WaterCompany, max_workers: int = 1, batch_size: Optional[int] = None,
+                 pbf: bool = False, base_uri: Optional[str] = None):
+        super().__init__(base_uri or data_urls[company], max_workers=max_workers, batch_size=batch_size, pbf=pbf)
+        self.converter: Optional[StreamConverter] = None
+
+    def _convert_features(self, features: List[Dict]) -> List[FeatureRecord]:
+        attributes = [f["attributes"] for f in features]
+        if self.converter is None and attributes:
+            self.converter = StreamConverter(attributes[0])
+        return self.converter.convert(attributes) if attributes else []
 
     def _convert(self, d: Dict) -> FeatureRecord:
         f = CaseInsensitiveDict(data=d)
@@ -248,11 +470,34 @@ class StreamAPI(ArcGisFeatureServer[FeatureRecord]):
             receivingWater=f["ReceivingWaterCourse"],
         )
 
+    def delta_features(self, previous: List[FeatureRecord]) -> Optional[List[FeatureRecord]]:
+        since = high_water_mark(previous)
+        if since is None:
+            return None
+
+        updated_since = f"LastUpdated > timestamp '{since.astimezone(datetime.UTC).strftime('%Y-%m-%d %H:%M:%S')}'"
+        merged = merge_features(previous, self.iter_features(where=updated_since))
+
+        # a delta can't see features that were deleted, so only trust the merge when it has as many ids as the
+        # service does - distinct ids, as the merge has one row per id and Severn Trent has duplicates. a count
+        # can't tell when as many were deleted as added, though
+        total = self._distinct_count('Id')
+        if total is None:
+            print(f">>> Can't count distinct ids for {self.layer_uri}, need a full download")
+            return None
+        if total != len(merged):
+            print(f">>> Delta has {len(merged)} features, service has {total}, need a full download")
+            return None
+
+        return merged
+
 
 class DwrCymruAPI(ArcGisFeatureServer[DwrCymruRecord]):
 
-    def __init__(self):
-        super().__init__(data_urls[WaterCompany.DwrCymru])
+    def __init__(self, max_workers: int = 1, batch_size: Optional[int] = None, pbf: bool = False,
+                 base_uri: Optional[str] = None):
+        super().__init__(base_uri or data_urls[WaterCompany.DwrCymru], max_workers=max_workers,
+                         batch_size=batch_size, pbf=pbf)
 
     def _convert(self, d: Dict) -> DwrCymruRecord:
         return DwrCymruRecord(
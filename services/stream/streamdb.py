@@ -1,6 +1,8 @@
 import dataclasses
 import datetime
-from typing import TypeVar, Callable, Tuple, Iterable, List, Dict, Optional
+import itertools
+import uuid
+from typing import TypeVar, Callable, Tuple, Iterable, List, Dict, Optional, BinaryIO, Set
 
 from companies import WaterCompany
 from stream import FeatureRecord, EventType
@@ -45,10 +47,46 @@ class StreamFile:
     file_time: datetime.datetime
 
 
+# stream_file_events and stream_file_content are partitioned by month of file_time - see stream-partitions.py
+PARTITIONED = ("stream_file_events", "stream_file_content")
+
+
+def partition_name(table: str, month: datetime.date) -> str:
+    return f"{table}_{month:%Y_%m}"
+
+
+def default_partition_name(table: str) -> str:
+    return f"{table}_default"
+
+
+def next_month(month: datetime.date) -> datetime.date:
+    return (month.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+
+
+def months_to(first: datetime.date, ahead: int) -> List[datetime.date]:
+    """from first's month to this one, and ahead more"""
+    last = datetime.date.today().replace(day=1)
+    for _ in range(ahead):
+        last = next_month(last)
+    months = []
+    month = first.replace(day=1)
+    while month <= last:
+        months.append(month)
+        month = next_month(month)
+    return months
+
+
+def as_uuid(v) -> uuid.UUID:
+    # binary copy needs the real thing, ids from the database already are
+    return v if isinstance(v, uuid.UUID) else uuid.UUID(str(v))
+
+
 class Database:
 
-    def __init__(self, connection):
+    def __init__(self, connection, batch_size: int = 10_000):
         self.connection = connection
+        self.batch_size = batch_size
+        self.migrated: Set[str] = set()
 
     def most_recent_loaded(self, company: WaterCompany) -> Optional[StreamFile]:
         things = list(select_many(self.connection,
@@ -86,17 +124,21 @@ class Database:
             return StreamFile(company=company, file_id=result["stream_file_id"], file_time=file_time)
 
     def files_unprocessed(self, company: WaterCompany) -> List[StreamFile]:
+        # everything up to the watermark has been processed, so only newer files need looking at
         return list(
             select_many(self.connection,
                         sql="""
-                            select stream_file_id, file_time
-                            from stream_files
-                            where company = %(company)s
-                              and stream_file_id not in
-                                  (select stream_file_id
-                                   from stream_files_processed
-                                   where stream_files_processed.company = %(company)s)
-                            order by file_time
+                            select f.stream_file_id, f.file_time
+                            from stream_files f
+                            where f.company = %(company)s
+                              and f.file_time > coalesce((select file_time
+                                                          from stream_files_watermark
+                                                          where company = %(company)s), '-infinity')
+                              and not exists (select 1
+                                              from stream_files_processed p
+                                              where p.company = f.company
+                                                and p.stream_file_id = f.stream_file_id)
+                            order by f.file_time
                             """,
                         params={
                             "company": company.name
@@ -115,6 +157,74 @@ class Database:
                     "file_id": file.file_id
                 }
             )
+            # move the watermark up to this file, unless an earlier one is still waiting
+            cursor.execute(
+                """
+                insert into stream_files_watermark (company, file_time)
+                select %(company)s, %(file_time)s
+                where not exists (select 1
+                                  from stream_files f
+                                  where f.company = %(company)s
+                                    and f.file_time < %(file_time)s
+                                    and f.file_time > coalesce((select file_time
+                                                                from stream_files_watermark
+                                                                where company = %(company)s), '-infinity')
+                                    and not exists (select 1
+                                                    from stream_files_processed p
+                                                    where p.company = f.company
+                                                      and p.stream_file_id = f.stream_file_id))
+                on conflict (company) do update
+                    set file_time = excluded.file_time
+                where excluded.file_time > stream_files_watermark.file_time
+                """, {
+                    "company": file.company.name,
+                    "file_time": file.file_time
+                }
+            )
+
+    def has_watermark(self, company: WaterCompany) -> bool:
+        return select_one(self.connection,
+                          sql="select exists (select 1 from stream_files_watermark where company = %(company)s) as found",
+                          params={"company": company.name}, f=lambda row: row["found"])
+
+    def rebuild_watermark(self, company: WaterCompany) -> int:
+        """sets the watermark to the last file before the first one that hasn't been processed"""
+        with self.connection.cursor() as cursor:
+            cursor.execute("delete from stream_files_watermark where company = %(company)s", {"company": company.name})
+            cursor.execute("""
+                           insert into stream_files_watermark (company, file_time)
+                           select %(company)s, max(f.file_time)
+                           from stream_files f
+                           where f.company = %(company)s
+                             and f.file_time < coalesce((select min(u.file_time)
+                                                         from stream_files u
+                                                         where u.company = %(company)s
+                                                           and not exists (select 1
+                                                                           from stream_files_processed p
+                                                                           where p.company = u.company
+                                                                             and p.stream_file_id = u.stream_file_id)),
+                                                        'infinity')
+                           having max(f.file_time) is not null
+                           """, {"company": company.name})
+            return cursor.rowcount
+
+    def check_watermark(self, company: WaterCompany) -> List[str]:
+        """files at or below the watermark that haven't been processed - files_unprocessed won't ever find them"""
+        return list(select_many(self.connection,
+                                sql="""
+                                    select f.stream_file_id
+                                    from stream_files f
+                                             join stream_files_watermark w on w.company = f.company
+                                    where f.company = %(company)s
+                                      and f.file_time <= w.file_time
+                                      and not exists (select 1
+                                                      from stream_files_processed p
+                                                      where p.company = f.company
+                                                        and p.stream_file_id = f.stream_file_id)
+                                    order by f.file_time
+                                    """,
+                                params={"company": company.name},
+                                f=lambda row: str(row["stream_file_id"])))
 
     def load_ids(self, company: WaterCompany):
         return {
@@ -130,30 +240,60 @@ class Database:
         }
 
     def insert_cso_events(self, events: List[StreamEvent]) -> int:
-        count = []
+        count = 0
         with self.connection.cursor() as cursor:
-            for event in events:
+            # binary copy into a session temp table, then one insert per batch
+            cursor.execute("""
+                           create temp table if not exists stream_cso_event_staging
+                           (
+                               stream_cso_id uuid,
+                               event_time    timestamptz,
+                               event         text,
+                               file_id       uuid,
+                               update_time   timestamptz
+                           ) on commit delete rows
+                           """)
+            for batch in itertools.batched(events, self.batch_size):
+                with cursor.copy("COPY stream_cso_event_staging FROM STDIN (FORMAT BINARY)") as copy:
+                    copy.set_types(["uuid", "timestamptz", "text", "uuid", "timestamptz"])
+                    for event in batch:
+                        copy.write_row((as_uuid(event.cso_id), event.event_time, event.event.name,
+                                        as_uuid(event.file_id), event.update_time))
                 cursor.execute("""
                                insert into stream_cso_event (stream_cso_id, event_time, event, file_id, update_time)
-                               values (%(cso_id)s, %(event_time)s, %(event)s, %(file_id)s, %(update_time)s)
-                               """, {
-                                   "cso_id": event.cso_id,
-                                   "event_time": event.event_time,
-                                   "event": event.event.name,
-                                   "file_id": event.file_id,
-                                   "update_time": event.update_time,
-                               })
-                count.append(cursor.rowcount)
-        return sum(count)
+                               select stream_cso_id, event_time, event, file_id, update_time
+                               from stream_cso_event_staging
+                               """)
+                count += cursor.rowcount
+                # keep each cso's latest event up to date in the same transaction - ordered as rebuild_cso_latest
+                # orders them, so an event with no time counts as the latest
+                cursor.execute("""
+                               insert into stream_cso_latest (stream_cso_id, event_time, event, file_id, update_time, file_time)
+                               select distinct on (e.stream_cso_id)
+                                      e.stream_cso_id, e.event_time, e.event, e.file_id, e.update_time, f.file_time
+                               from stream_cso_event_staging e
+                                        join stream_files f on f.stream_file_id = e.file_id
+                               order by e.stream_cso_id, e.event_time desc nulls first, f.file_time desc
+                               on conflict (stream_cso_id) do update
+                                   set event_time  = excluded.event_time,
+                                       event       = excluded.event,
+                                       file_id     = excluded.file_id,
+                                       update_time = excluded.update_time,
+                                       file_time   = excluded.file_time
+                               where (excluded.event_time is null and stream_cso_latest.event_time is not null)
+                                  or excluded.event_time > stream_cso_latest.event_time
+                                  or (excluded.event_time is not distinct from stream_cso_latest.event_time
+                                      and excluded.file_time >= stream_cso_latest.file_time)
+                               """)
+                cursor.execute("truncate stream_cso_event_staging")
+        return count
 
     def last_seen_cso(self, company: WaterCompany) -> Dict[str, datetime.datetime]:
         return {c[0]: c[1] for c in select_many(connection=self.connection,
                                                 sql="""
-                                                    select c.id as stream_id, max(f.file_time) as last_seen_time
-                                                    from stream_file_content c
-                                                             join stream_files f using (stream_file_id)
-                                                    where f.company = %(company)s
-                                                    group by c.id
+                                                    select id as stream_id, last_seen_time
+                                                    from stream_cso_last_seen
+                                                    where company = %(company)s
                                                     order by last_seen_time;
                                                     """,
                                                 params={
@@ -162,20 +302,52 @@ class Database:
                                                 f=lambda row: (row["stream_id"], row["last_seen_time"]))
                 }
 
+    def has_cso_last_seen(self, company: WaterCompany) -> bool:
+        return select_one(self.connection,
+                          sql="select exists (select 1 from stream_cso_last_seen where company = %(company)s) as found",
+                          params={"company": company.name}, f=lambda row: row["found"])
+
+    def rebuild_cso_last_seen(self, company: WaterCompany) -> int:
+        """recreates the company's rows in stream_cso_last_seen from the whole of stream_file_content"""
+        with self.connection.cursor() as cursor:
+            cursor.execute("delete from stream_cso_last_seen where company = %(company)s", {"company": company.name})
+            cursor.execute("""
+                           insert into stream_cso_last_seen (company, id, last_seen_time)
+                           select f.company, c.id, max(f.file_time)
+                           from stream_file_content c
+                                    join stream_files f using (stream_file_id)
+                           where f.company = %(company)s
+                           group by f.company, c.id
+                           """, {"company": company.name})
+            return cursor.rowcount
+
+    def check_cso_last_seen(self, company: WaterCompany) -> List[str]:
+        """ids whose last seen time in stream_cso_last_seen isn't their latest file in stream_file_content"""
+        return list(select_many(connection=self.connection,
+                                sql="""
+                                    with expected as (select c.id, max(f.file_time) as last_seen_time
+                                                      from stream_file_content c
+                                                               join stream_files f using (stream_file_id)
+                                                      where f.company = %(company)s
+                                                      group by c.id),
+                                         actual as (select * from stream_cso_last_seen where company = %(company)s)
+                                    select coalesce(e.id, a.id) as id
+                                    from expected e
+                                             full outer join actual a on e.id = a.id
+                                    where e.last_seen_time is distinct from a.last_seen_time
+                                    order by 1
+                                    """,
+                                params={"company": company.name},
+                                f=lambda row: row["id"]))
+
     def latest_cso_events(self, company: WaterCompany) -> Dict[str, StreamEvent]:
         return {e[0]: e[1]
                 for e in select_many(
                 connection=self.connection,
                 sql="""
-                    WITH ranked_events AS (SELECT e.*,
-                                                  ROW_NUMBER()
-                                                      OVER (PARTITION BY e.stream_cso_id ORDER BY e.event_time DESC, stream_files.file_time desc) AS rnk
-                                           FROM stream_cso_event as e
-                                                    join stream_files on stream_files.stream_file_id = e.file_id
-                                           where stream_files.company = %(company)s)
                     SELECT m.stream_id, e.file_id, e.event, e.event_time, e.update_time, m.stream_cso_id
                     FROM stream_cso m
-                             JOIN ranked_events e ON m.stream_cso_id = e.stream_cso_id AND e.rnk = 1
+                             JOIN stream_cso_latest e ON m.stream_cso_id = e.stream_cso_id
                     where m.stream_company = %(company)s;
                     """,
                 params={
@@ -190,19 +362,92 @@ class Database:
                 ))
             )}
 
+    def has_cso_latest(self, company: WaterCompany) -> bool:
+        return select_one(self.connection,
+                          sql="""
+                              select exists (select 1
+                                             from stream_cso_latest l
+                                                      join stream_cso m on m.stream_cso_id = l.stream_cso_id
+                                             where m.stream_company = %(company)s) as found
+                              """,
+                          params={"company": company.name}, f=lambda row: row["found"])
+
+    def rebuild_cso_latest(self, company: WaterCompany) -> int:
+        """recreates the company's rows in stream_cso_latest from the whole event history"""
+        with self.connection.cursor() as cursor:
+            cursor.execute("""
+                           delete
+                           from stream_cso_latest
+                           where stream_cso_id in (select stream_cso_id from stream_cso where stream_company = %(company)s)
+                           """, {"company": company.name})
+            cursor.execute("""
+                           WITH ranked_events AS (SELECT e.*,
+                                                         stream_files.file_time,
+                                                         ROW_NUMBER()
+                                                             OVER (PARTITION BY e.stream_cso_id ORDER BY e.event_time DESC NULLS FIRST, stream_files.file_time desc) AS rnk
+                                                  FROM stream_cso_event as e
+                                                           join stream_files on stream_files.stream_file_id = e.file_id
+                                                  where stream_files.company = %(company)s)
+                           insert into stream_cso_latest (stream_cso_id, event_time, event, file_id, update_time, file_time)
+                           SELECT e.stream_cso_id, e.event_time, e.event, e.file_id, e.update_time, e.file_time
+                           FROM stream_cso m
+                                    JOIN ranked_events e ON m.stream_cso_id = e.stream_cso_id AND e.rnk = 1
+                           where m.stream_company = %(company)s
+                           """, {"company": company.name})
+            return cursor.rowcount
+
+    def check_cso_latest(self, company: WaterCompany) -> List[str]:
+        """stream ids whose row in stream_cso_latest isn't their latest event in stream_cso_event"""
+        return list(select_many(connection=self.connection,
+                                sql="""
+                                    with expected as (select distinct on (e.stream_cso_id) e.*
+                                                      from stream_cso_event e
+                                                               join stream_files f on f.stream_file_id = e.file_id
+                                                      where f.company = %(company)s
+                                                      order by e.stream_cso_id, e.event_time desc nulls first, f.file_time desc),
+                                         actual as (select l.*
+                                                    from stream_cso_latest l
+                                                             join stream_cso m on m.stream_cso_id = l.stream_cso_id
+                                                    where m.stream_company = %(company)s)
+                                    select m.stream_id
+                                    from expected e
+                                             full outer join actual a on e.stream_cso_id = a.stream_cso_id
+                                             join stream_cso m on m.stream_cso_id = coalesce(e.stream_cso_id, a.stream_cso_id)
+                                    where m.stream_company = %(company)s
+                                      and (e.file_id, e.event, e.event_time, e.update_time)
+                                        is distinct from (a.file_id, a.event, a.event_time, a.update_time)
+                                    order by 1
+                                    """,
+                                params={"company": company.name},
+                                f=lambda row: row["stream_id"]))
+
     def insert_cso(self, company: WaterCompany, features: List[FeatureRecord]):
         with self.connection.cursor() as cursor:
-            for feature in features:
+            cursor.execute("""
+                           create temp table if not exists stream_cso_staging
+                           (
+                               stream_company text,
+                               stream_id      text,
+                               lat            float,
+                               lon            float
+                           ) on commit delete rows
+                           """)
+            for batch in itertools.batched(features, self.batch_size):
+                with cursor.copy("COPY stream_cso_staging FROM STDIN (FORMAT BINARY)") as copy:
+                    copy.set_types(["text", "text", "float8", "float8"])
+                    for feature in batch:
+                        copy.write_row((company.name, feature.id, feature.lat, feature.lon))
+                # the points are made here, as psycopg can't send a postgis geometry in binary
                 cursor.execute("""
                                insert into stream_cso (stream_company, stream_id, lat, lon, point)
-                               VALUES (%(company)s, %(id)s, %(lat)s, %(lon)s,
-                                       st_setsrid(st_makepoint(%(lon)s, %(lat)s), 4326)) on conflict (stream_company, stream_id) do nothing
-                               """, {
-                                   "company": company.name,
-                                   "id": feature.id,
-                                   "lat": feature.lat,
-                                   "lon": feature.lon,
-                               })
+                               select distinct on (stream_company, stream_id)
+                                      stream_company, stream_id, lat, lon,
+                                      st_setsrid(st_makepoint(lon, lat), 4326)
+                               from stream_cso_staging
+                               order by stream_company, stream_id
+                               on conflict (stream_company, stream_id) do nothing
+                               """)
+                cursor.execute("truncate stream_cso_staging")
 
     def _record_from_row(self, company: WaterCompany, r) -> FeatureRecord:
         return FeatureRecord(
@@ -221,26 +466,10 @@ class Database:
     def most_recent_records(self, company: WaterCompany) -> List[FeatureRecord]:
         return list(select_many(connection=self.connection,
                                 sql="""
-                                    WITH ranked_events AS (SELECT files.stream_file_id,
-                                                                  files.file_time,
-                                                                  files.company,
-                                                                  content.id,
-                                                                  content.status,
-                                                                  content.statusstart,
-                                                                  content.latesteventstart,
-                                                                  content.latesteventend,
-                                                                  content.lastupdated,
-                                                                  content.lat,
-                                                                  content.lon,
-                                                                  content.receiving_water,
-                                                                  ROW_NUMBER() OVER (PARTITION BY id ORDER BY file_time desc) AS rn
-                                                           FROM stream_file_events content
-                                                                    join stream_files files on content.stream_file_id = files.stream_file_id
-                                                           where company = %(company)s)
-                                    SELECT *
-                                    FROM ranked_events
-                                    WHERE rn = 1
-                                    order by company, id, file_time, id
+                                    select *
+                                    from stream_file_events_latest
+                                    where company = %(company)s
+                                    order by id
                                     """,
                                 params={
                                     "company": company.name
@@ -248,6 +477,51 @@ class Database:
                                 f=lambda r: self._record_from_row(company, r))
                     )
 
+    def has_file_events_latest(self, company: WaterCompany) -> bool:
+        return select_one(self.connection,
+                          sql="select exists (select 1 from stream_file_events_latest where company = %(company)s) as found",
+                          params={"company": company.name}, f=lambda row: row["found"])
+
+    def rebuild_file_events_latest(self, company: WaterCompany) -> int:
+        """recreates the company's rows in stream_file_events_latest from the whole of stream_file_events"""
+        with self.connection.cursor() as cursor:
+            cursor.execute("delete from stream_file_events_latest where company = %(company)s", {"company": company.name})
+            cursor.execute("""
+                           insert into stream_file_events_latest
+                           select distinct on (content.id) files.company, content.id, files.stream_file_id, files.file_time,
+                                  content.status, content.statusstart, content.latesteventstart, content.latesteventend,
+                                  content.lastupdated, content.lat, content.lon, content.receiving_water
+                           from stream_file_events content
+                                    join stream_files files on content.stream_file_id = files.stream_file_id
+                           where files.company = %(company)s
+                           order by content.id, files.file_time desc
+                           """, {"company": company.name})
+            return cursor.rowcount
+
+    def check_file_events_latest(self, company: WaterCompany) -> List[str]:
+        """ids whose row in stream_file_events_latest isn't their latest in stream_file_events"""
+        return list(select_many(connection=self.connection,
+                                sql="""
+                                    with expected as (select distinct on (content.id) content.*
+                                                      from stream_file_events content
+                                                               join stream_files files on content.stream_file_id = files.stream_file_id
+                                                      where files.company = %(company)s
+                                                      order by content.id, files.file_time desc),
+                                         actual as (select * from stream_file_events_latest where company = %(company)s)
+                                    select coalesce(e.id, a.id) as id
+                                    from expected e
+                                             full outer join actual a on e.id = a.id
+                                    where e.id is null
+                                       or a.id is null
+                                       or (e.stream_file_id, e.file_time, e.status, e.statusstart, e.latesteventstart,
+                                           e.latesteventend, e.lastupdated, e.lat, e.lon, e.receiving_water)
+                                        is distinct from (a.stream_file_id, a.file_time, a.status, a.statusstart, a.latesteventstart,
+                                                          a.latesteventend, a.lastupdated, a.lat, a.lon, a.receiving_water)
+                                    order by 1
+                                    """,
+                                params={"company": company.name},
+                                f=lambda row: row["id"]))
+
     def load_file_records(self, file: StreamFile) -> List[FeatureRecord]:
         return list(
             select_many(
@@ -258,22 +532,69 @@ class Database:
                          stream_file_events
                     where stream_files.stream_file_id = stream_file_events.stream_file_id
                       and stream_files.stream_file_id = %(file_id)s
+                      and stream_file_events.file_time = %(file_time)s
                     """,
                 params={
-                    "file_id": file.file_id
+                    "file_id": file.file_id,
+                    "file_time": file.file_time
                 },
                 f=lambda row: self._record_from_row(file.company, row))
         )
 
     def insert_file_events(self, file: StreamFile, features: List[FeatureRecord]):
         self._insert_records("stream_file_events", file, features)
+        # and each cso's latest record, for most_recent_records - a file older than the latest changes nothing
+        with self.connection.cursor() as cursor:
+            cursor.execute("""
+                           insert into stream_file_events_latest
+                           select %(company)s, id, stream_file_id, %(file_time)s, status, statusstart, latesteventstart,
+                                  latesteventend, lastupdated, lat, lon, receiving_water
+                           from stream_file_events
+                           where stream_file_id = %(file_id)s
+                             and file_time = %(file_time)s
+                           on conflict (company, id) do update
+                               set stream_file_id   = excluded.stream_file_id,
+                                   file_time        = excluded.file_time,
+                                   status           = excluded.status,
+                                   statusstart      = excluded.statusstart,
+                                   latesteventstart = excluded.latesteventstart,
+                                   latesteventend   = excluded.latesteventend,
+                                   lastupdated      = excluded.lastupdated,
+                                   lat              = excluded.lat,
+                                   lon              = excluded.lon,
+                                   receiving_water  = excluded.receiving_water
+                           where excluded.file_time >= stream_file_events_latest.file_time
+                           """, {
+                               "company": file.company.name,
+                               "file_time": file.file_time,
+                               "file_id": file.file_id
+                           })
 
     def insert_file_content(self, file: StreamFile, features: List[FeatureRecord]):
         self._insert_records("stream_file_content", file, features)
+        # and when each cso was last seen, for last_seen_cso
+        with self.connection.cursor() as cursor:
+            cursor.execute("""
+                           insert into stream_cso_last_seen (company, id, last_seen_time)
+                           select %(company)s, id, %(file_time)s
+                           from unnest(%(ids)s::text[]) as id
+                           on conflict (company, id) do update
+                               set last_seen_time = greatest(stream_cso_last_seen.last_seen_time, excluded.last_seen_time)
+                           """, {
+                               "company": file.company.name,
+                               "file_time": file.file_time,
+                               "ids": sorted({feature.id for feature in features})
+                           })
 
     def _insert_records(self, table: str, file: StreamFile, features: List[FeatureRecord]):
+        # file_time only exists once the table's been partitioned - say so, rather than fail every load on the column
+        if table not in self.migrated:
+            if not self.partitioned(table):
+                raise RuntimeError(f"{table} isn't partitioned by file_time yet - run stream-partitions.py migrate")
+            self.migrated.add(table)
         with self.connection.cursor() as cursor:
-            with cursor.copy(f"COPY {table} FROM STDIN") as copy:
+            with cursor.copy(f"""COPY {table} (stream_file_id, id, status, statusstart, latesteventstart, latesteventend,
+                                                lastupdated, lat, lon, receiving_water, file_time) FROM STDIN""") as copy:
                 for feature in features:
                     copy.write_row(
                         (file.file_id,
@@ -285,7 +606,8 @@ class Database:
                          feature.lastUpdated,
                          feature.lat,
                          feature.lon,
-                         feature.receivingWater)
+                         feature.receivingWater,
+                         file.file_time)
                     )
 
     def load_file_events_for(self, company: WaterCompany, stream_id: str) -> Iterable[FeatureRecord]:
@@ -300,3 +622,103 @@ class Database:
                                 params={"id": stream_id},
                                 f=lambda row: self._record_from_row(company, row))
                     )
+
+    def partitions(self, table: str) -> List[datetime.date]:
+        """the months the table has a partition for (not counting the default one)"""
+        prefix = f"{table}_"
+        return sorted(datetime.datetime.strptime(r["name"].removeprefix(prefix), "%Y_%m").date()
+                      for r in select_many(self.connection,
+                                           sql="""
+                                               select child.relname as name
+                                               from pg_inherits
+                                                        join pg_class parent on pg_inherits.inhparent = parent.oid
+                                                        join pg_class child on pg_inherits.inhrelid = child.oid
+                                               where parent.relname = %(table)s
+                                               """,
+                                           params={"table": table})
+                      if r["name"] != default_partition_name(table))
+
+    def partitioned(self, table: str) -> bool:
+        return select_one(self.connection,
+                          sql="""
+                              select exists (select 1
+                                             from pg_partitioned_table p
+                                                      join pg_class c on c.oid = p.partrelid
+                                             where c.relname = %(table)s) as found
+                              """,
+                          params={"table": table}, f=lambda row: row["found"])
+
+    def table_exists(self, name: str) -> bool:
+        return select_one(self.connection, sql="select to_regclass(%(name)s) is not null as found",
+                          params={"name": name}, f=lambda row: row["found"])
+
+    def create_partitions(self, table: str, months: Iterable[datetime.date]) -> List[str]:
+        created = []
+        existing = set(self.partitions(table))
+        with self.connection.cursor() as cursor:
+            for month in months:
+                if month in existing:
+                    continue
+                name = partition_name(table, month)
+                # a month that's been rolled up (and not dropped) is still there, just detached - leave it be
+                if self.table_exists(name):
+                    continue
+                start, end = month.isoformat(), next_month(month).isoformat()
+                # anything that landed in the default partition for the month has to move before it can be attached
+                cursor.execute(f"create table {name} (like {table} including defaults)")
+                cursor.execute(f"""
+                                with moved as (delete from {default_partition_name(table)}
+                                               where file_time >= '{start}' and file_time < '{end}'
+                                               returning *)
+                                insert into {name} select * from moved
+                                """)
+                cursor.execute(f"alter table {table} attach partition {name} for values from ('{start}') to ('{end}')")
+                created.append(name)
+        return created
+
+    def copy_partition(self, table: str, month: datetime.date, out: BinaryIO):
+        with self.connection.cursor() as cursor:
+            with cursor.copy(f"COPY {partition_name(table, month)} TO STDOUT (FORMAT csv, HEADER)") as copy:
+                for data in copy:
+                    out.write(data)
+
+    def detach_partition(self, table: str, month: datetime.date, drop: bool):
+        name = partition_name(table, month)
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"alter table {table} detach partition {name}")
+            if drop:
+                cursor.execute(f"drop table {name}")
+
+    def partition_table(self, table: str, ahead: int) -> int:
+        """
+        replaces an unpartitioned table with a partitioned one, with the rows copied across (and file_time from
+        stream_files). the old table is kept as {table}_unpartitioned
+        """
+        old = f"{table}_unpartitioned"
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"alter table {table} rename to {old}")
+            cursor.execute(f"alter index {table}_idx1 rename to {old}_idx1")
+            cursor.execute(f"""
+                            create table {table}
+                            (
+                                like {old} including defaults,
+                                file_time timestamptz not null
+                            ) partition by range (file_time)
+                            """)
+            cursor.execute(f"create table {default_partition_name(table)} partition of {table} default")
+            first = select_one(self.connection,
+                               sql=f"select min(f.file_time) as first from {old} join stream_files f using (stream_file_id)",
+                               f=lambda row: row["first"])
+            self.create_partitions(table, months_to(first.date() if first is not None else datetime.date.today(), ahead))
+            cursor.execute(f"""
+                            insert into {table}
+                            select o.*, f.file_time
+                            from {old} o
+                                     join stream_files f using (stream_file_id)
+                            """)
+            count = cursor.rowcount
+            cursor.execute(f"create unique index {table}_idx1 on {table} (stream_file_id, id, file_time)")
+            if table == "stream_file_events":
+                cursor.execute(f"alter index idx_stream_file_events_id_stream_file_id rename to idx_{old}_id_stream_file_id")
+                cursor.execute("create index idx_stream_file_events_id_stream_file_id on stream_file_events (id, stream_file_id)")
+        return count
@@ -0,0 +1,89 @@
+import struct
+
+from arcgis_pbf import decode_feature_query
+
+
+def varint(n: int) -> bytes:
+    n &= (1 << 64) - 1
+    out = bytearray()
+    while True:
+        b = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return bytes(out)
+
+
+def zigzag(n: int) -> int:
+    return (n << 1) ^ (n >> 63)
+
+
+def field(number: int, wire: int, payload: bytes) -> bytes:
+    key = varint(number << 3 | wire)
+    if wire == 2:
+        return key + varint(len(payload)) + payload
+    return key + payload
+
+
+def message(number: int, *parts: bytes) -> bytes:
+    return field(number, 2, b''.join(parts))
+
+
+def string(number: int, s: str) -> bytes:
+    return field(number, 2, s.encode())
+
+
+def double(number: int, d: float) -> bytes:
+    return field(number, 1, struct.pack('<d', d))
+
+
+def feature_collection(fields, features, transform=b'') -> bytes:
+    result = string(1, "OBJECTID") + transform + b''.join(fields) + b''.join(features)
+    return string(1, "1.0") + message(2, message(1, result))
+
+
+def test_decodes_attributes_and_geometry():
+    transform = message(12,
+                        field(1, 0, varint(0)),
+                        message(2, double(1, 0.001), double(2, 0.001)),
+                        message(3, double(1, -2.0), double(2, 55.0)))
+    fields = [
+        message(13, string(1, "OBJECTID"), field(2, 0, varint(6))),
+        message(13, string(1, "Id"), field(2, 0, varint(4))),
+        message(13, string(1, "Status"), field(2, 0, varint(1))),
+        message(13, string(1, "LastUpdated"), field(2, 0, varint(5))),
+        message(13, string(1, "Latitude"), field(2, 0, varint(3))),
+        message(13, string(1, "ReceivingWaterCourse"), field(2, 0, varint(4))),
+    ]
+    coords = varint(zigzag(868)) + varint(zigzag(391))
+    features = [
+        message(15,
+                message(1, field(5, 0, varint(1539))),
+                message(1, string(1, "NES0141")),
+                message(1, field(4, 0, varint(zigzag(-1)))),
+                message(1, field(6, 0, varint(1735345436350))),
+                message(1, double(3, 54.60886)),
+                message(1),
+                message(2, field(3, 2, coords)))
+    ]
+
+    decoded = decode_feature_query(feature_collection(fields, features, transform))
+
+    assert decoded['objectIdFieldName'] == "OBJECTID"
+    assert decoded['features'][0]['attributes'] == {
+        "OBJECTID": 1539,
+        "Id": "NES0141",
+        "Status": -1,
+        "LastUpdated": 1735345436350,
+        "Latitude": 54.60886,
+        "ReceivingWaterCourse": None,
+    }
+    geometry = decoded['features'][0]['geometry']
+    assert abs(geometry['x'] - -1.132) < 1e-9
+    assert abs(geometry['y'] - 54.609) < 1e-9
+
+
+def test_decodes_empty_result():
+    assert decode_feature_query(feature_collection([], []))['features'] == []
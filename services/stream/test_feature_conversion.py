@@ -1,6 +1,7 @@
 import datetime
 
-from stream import DwrCymruRecord, EventType
+from companies import WaterCompany
+from stream import DwrCymruRecord, EventType, StreamAPI, StreamConverter, x
 
 another_date = datetime.datetime.fromisoformat("2034-04-03T23:45:56")
 some_date = datetime.datetime.fromisoformat("2001-04-03T23:45:56")
@@ -42,3 +43,14 @@ def test_convert_dwr_stop():
     assert f.lon == 456
     assert f.id == d.GlobalID
 
+
+
+def test_compiled_stream_converter_matches_convert():
+    api = StreamAPI(company=WaterCompany.Northumbrian)
+    lower = {k.lower(): v for k, v in x.items()}
+    offline = dict(x, StatusStart=None, LatestEventStart=None, LatestEventEnd=None)
+
+    converted = StreamConverter(x).convert([x, offline])
+
+    assert converted == [api._convert(x), api._convert(offline)]
+    assert StreamConverter(lower).convert([lower]) == [api._convert(x)]
@@ -0,0 +1,130 @@
+import datetime
+import random
+import time
+from typing import Dict, List, Optional
+
+from companies import WaterCompany
+from standin import StandInServer, Recording
+from stream import ArcGisFeatureServer, FeatureList, FeatureRecord, high_water_mark, merge_features, StreamAPI, x, \
+    host_limit
+
+
+class FakeFeatureServer(ArcGisFeatureServer[int]):
+
+    def __init__(self, ids: List[int], max_workers: int):
+        super().__init__("https://fake.example.com/FeatureServer/0/query", max_workers=max_workers, batch_size=100)
+        self.ids = ids
+
+    def _feature_list(self, where: str = '1=1') -> FeatureList:
+        return FeatureList(name="OBJECTID", ids=self.ids)
+
+    def _features(self, oids: List[int], pbf: bool = False) -> List[int]:
+        # finish batches out of order
+        time.sleep(random.random() / 100)
+        return [self._convert({"OBJECTID": oid}) for oid in oids]
+
+    def _convert(self, d: Dict) -> int:
+        return d["OBJECTID"]
+
+
+def test_serial_features():
+    ids = list(range(1234))
+    assert FakeFeatureServer(ids, max_workers=1).features() == ids
+
+
+def test_concurrent_features_keep_order():
+    ids = list(range(1234))
+    assert FakeFeatureServer(ids, max_workers=8).features() == ids
+
+
+def record(id: str, status: str, updated: Optional[datetime.datetime]) -> FeatureRecord:
+    return FeatureRecord(id=id, status=status, company="Company", statusStart=None, latestEventStart=None,
+                         latestEventEnd=None, lastUpdated=updated, lat=1.0, lon=2.0, receivingWater="River")
+
+
+def test_high_water_mark():
+    early = datetime.datetime(2025, 1, 1, tzinfo=datetime.UTC)
+    late = datetime.datetime(2025, 1, 2, tzinfo=datetime.UTC)
+
+    assert high_water_mark([record("a", "0", early), record("b", "0", None), record("c", "0", late)]) == late
+    assert high_water_mark([record("a", "0", None)]) is None
+
+
+def test_merge_features():
+    early = datetime.datetime(2025, 1, 1, tzinfo=datetime.UTC)
+    late = datetime.datetime(2025, 1, 2, tzinfo=datetime.UTC)
+
+    previous = [record("a", "0", early), record("b", "0", early)]
+    merged = merge_features(previous, [record("b", "1", late), record("c", "0", late)])
+
+    assert [(f.id, f.status) for f in merged] == [("a", "0"), ("b", "1"), ("c", "0")]
+
+
+def test_long_queries_are_posted():
+    server = FakeFeatureServer([], max_workers=1)
+    calls = []
+    server.session.get = lambda url, params: calls.append(("GET", params))
+    server.session.post = lambda url, data: calls.append(("POST", data))
+
+    server._query({'objectIds': ','.join(str(i) for i in range(10))})
+    server._query({'objectIds': ','.join(str(i) for i in range(1000))})
+
+    assert [c[0] for c in calls] == ["GET", "POST"]
+
+
+def test_stream_api_against_stand_in():
+    features = [
+        {"attributes": dict(x, OBJECTID=i, Id=f"NES{i:05}", LastUpdated=x["LastUpdated"] + i * 60_000)}
+        for i in range(250)
+    ]
+    recording = Recording(layer={}, objectIdFieldName="OBJECTID", objectIds=[i for i in range(250)] + [0],
+                          features=features)
+
+    with StandInServer({WaterCompany.Northumbrian: recording}, port=0) as standin:
+        api = StreamAPI(WaterCompany.Northumbrian, max_workers=4, batch_size=100,
+                        base_uri=standin.uri(WaterCompany.Northumbrian))
+
+        assert [f.id for f in api.features()] == [f"NES{i:05}" for i in range(250)]
+        assert standin.requests == {"ids": 1, "features": 3}
+
+        since = api._convert(features[199]["attributes"]).lastUpdated
+        updated = api.iter_features(where=f"LastUpdated > timestamp '{since:%Y-%m-%d %H:%M:%S}'")
+        assert [f.id for f in updated] == [f"NES{i:05}" for i in range(199, 250)]
+
+
+def test_delta_counts_distinct_ids():
+    # two objects with the same id, as Severn Trent has
+    features = [
+        {"attributes": dict(x, OBJECTID=i, Id=f"NES{min(i, 98):05}", LastUpdated=x["LastUpdated"] + i * 60_000)}
+        for i in range(100)
+    ]
+    recording = Recording(layer={}, objectIdFieldName="OBJECTID", objectIds=list(range(100)), features=features)
+
+    with StandInServer({WaterCompany.Northumbrian: recording}, port=0) as standin:
+        api = StreamAPI(WaterCompany.Northumbrian, batch_size=100, base_uri=standin.uri(WaterCompany.Northumbrian))
+        previous = api.features()[:90]
+        standin.requests.clear()
+
+        merged = api.delta_features(previous)
+        assert merged is not None and len(merged) == 99
+        assert standin.requests == {"ids": 1, "features": 1, "count": 1}
+
+
+def test_host_limit_shared_and_first_limit_kept(capsys):
+    first = host_limit("https://limited.example.com/a/FeatureServer/0/query", 2)
+    second = host_limit("https://limited.example.com/b/FeatureServer/0/query", 5)
+
+    assert first is second
+    assert "already limited to 2" in capsys.readouterr().out
+
+
+def test_stand_in_layer_not_cached():
+    recording = Recording(layer={'maxRecordCount': 50}, objectIdFieldName="OBJECTID", objectIds=[], features=[])
+
+    with StandInServer({WaterCompany.Northumbrian: recording}, port=0) as standin:
+        api = StreamAPI(WaterCompany.Northumbrian, base_uri=standin.uri(WaterCompany.Northumbrian))
+        assert api._batch_size() == 50
+
+        recording.layer['maxRecordCount'] = 80
+        assert api._batch_size() == 80
+        assert standin.requests['layer'] == 2
@@ -0,0 +1,214 @@
+import datetime
+import hashlib
+import io
+from types import SimpleNamespace
+
+import botocore.exceptions
+
+import bundle
+from companies import WaterCompany
+from storage import S3Storage
+
+
+def client_error(code: str, operation: str) -> botocore.exceptions.ClientError:
+    return botocore.exceptions.ClientError({'Error': {'Code': code}}, operation)
+
+
+class FakeClient:
+    """just the parts of an s3 client that S3Storage uses, with conditional puts"""
+
+    def __init__(self):
+        self.objects = {}
+        self.calls = []
+
+    def get_object(self, Bucket, Key, Range=None):
+        self.calls.append(('get', Key) if Range is None else ('get', Key, Range))
+        if Key not in self.objects:
+            raise client_error('NoSuchKey', 'GetObject')
+        body = self.objects[Key]
+        etag = hashlib.md5(body).hexdigest()
+        if Range is not None:
+            first, last = Range.removeprefix('bytes=').split('-')
+            body = body[int(first):int(last) + 1]
+        return {'Body': io.BytesIO(body), 'ETag': etag}
+
+    def put_object(self, Bucket, Key, Body, ContentType=None, IfMatch=None, IfNoneMatch=None):
+        self.calls.append(('put', Key))
+        current = self.objects.get(Key)
+        if IfNoneMatch == '*' and current is not None:
+            raise client_error('PreconditionFailed', 'PutObject')
+        if IfMatch is not None and (current is None or hashlib.md5(current).hexdigest() != IfMatch):
+            raise client_error('PreconditionFailed', 'PutObject')
+        self.objects[Key] = Body
+
+    def upload_fileobj(self, Fileobj, Bucket, Key):
+        self.put_object(Bucket, Key, Fileobj.read())
+
+    def head_object(self, Bucket, Key):
+        self.calls.append(('head', Key))
+        if Key not in self.objects:
+            raise client_error('404', 'HeadObject')
+
+    def delete_objects(self, Bucket, Delete):
+        self.calls.append(('delete', len(Delete['Objects'])))
+        for o in Delete['Objects']:
+            self.objects.pop(o['Key'], None)
+
+    def get_paginator(self, name):
+        client = self
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix):
+                client.calls.append(('list', Prefix))
+                return [{'Contents': [{'Key': k} for k in sorted(client.objects) if k.startswith(Prefix)]}]
+
+        return Paginator()
+
+
+def s3_storage(client: FakeClient, **kwargs) -> S3Storage:
+    return S3Storage(SimpleNamespace(name='bucket', meta=SimpleNamespace(client=client)), **kwargs)
+
+
+def test_save_keeps_manifest():
+    client = FakeClient()
+    storage = s3_storage(client)
+    now = datetime.datetime.now(tz=datetime.UTC).replace(microsecond=0)
+    times = [now - datetime.timedelta(minutes=m) for m in [30, 15, 0]]
+
+    for t in times:
+        storage.save(WaterCompany.Anglian, t, "a,b\n")
+
+    client.calls.clear()
+    assert list(storage.available(WaterCompany.Anglian, since=times[0])) == times[1:]
+    assert not [c for c in client.calls if c[0] == 'list']
+
+
+def test_available_lists_and_writes_missing_manifest():
+    client = FakeClient()
+    storage = s3_storage(client)
+    now = datetime.datetime.now(tz=datetime.UTC).replace(microsecond=0)
+    client.objects[f"Anglian/{now:%Y/%m/%d/%Y%m%d%H%M%S}.csv.gz"] = b""
+
+    assert list(storage.available(WaterCompany.Anglian, since=now - datetime.timedelta(minutes=1))) == [now]
+    assert f"Anglian/{now:%Y/%m}/manifest.json" in client.objects
+
+    client.calls.clear()
+    assert list(storage.available(WaterCompany.Anglian, since=now - datetime.timedelta(minutes=1))) == [now]
+    assert not [c for c in client.calls if c[0] == 'list']
+
+
+def test_manifest_update_retries_when_changed():
+    client = FakeClient()
+    storage = s3_storage(client)
+    now = datetime.datetime.now(tz=datetime.UTC).replace(microsecond=0)
+    earlier = now - datetime.timedelta(seconds=1)
+    storage.save(WaterCompany.Anglian, earlier, "a,b\n")
+
+    put_object = client.put_object
+
+    def interfering_put(**kwargs):
+        # someone else adds a file between our read and write - once
+        client.put_object = put_object
+        storage._record(WaterCompany.Anglian, now - datetime.timedelta(seconds=2))
+        put_object(**kwargs)
+
+    client.put_object = interfering_put
+    storage._record(WaterCompany.Anglian, now)
+
+    assert list(storage.available(WaterCompany.Anglian, since=now - datetime.timedelta(minutes=1))) == [
+        now - datetime.timedelta(seconds=2), earlier, now
+    ]
+
+
+def test_bundle_round_trip():
+    files = {"20250101000000.csv.gz": b"one", "20250101001500.csv.gz": b"", "20250101003000.parquet": b"three"}
+    packed = bundle.pack(files)
+
+    assert bundle.unpack(packed) == files
+    index = bundle.BundleIndex.parse(packed[:bundle.header_length(packed)])
+    first, last = index.range("20250101003000.parquet")
+    assert packed[first:last + 1] == b"three"
+    assert index.range("20250101004500.csv.gz") is None
+
+
+def test_compacted_day_loads_from_bundle():
+    client = FakeClient()
+    storage = s3_storage(client)
+    day = datetime.datetime(2025, 3, 4, tzinfo=datetime.UTC)
+    times = [day + datetime.timedelta(minutes=15 * m) for m in range(4)]
+    for t in times:
+        storage.save(WaterCompany.Anglian, t, f"a,b\n{t}\n")
+
+    assert storage.compact(WaterCompany.Anglian, day.date(), delete=True) == len(times)
+    assert [k for k in client.objects if k.startswith("Anglian/2025/03/04/")] == ["Anglian/2025/03/04/bundle.bin"]
+
+    client.calls.clear()
+    reader = s3_storage(client)
+    assert reader._files_on(WaterCompany.Anglian, day.date()) == times
+    assert [reader.load(WaterCompany.Anglian, t) for t in times] == [f"a,b\n{t}\n" for t in times]
+    # one listing, one read of the index, one read of the whole bundle
+    assert len(client.calls) == 3
+
+
+def test_compacted_day_loads_with_ranges():
+    client = FakeClient()
+    storage = s3_storage(client)
+    day = datetime.datetime(2025, 3, 4, tzinfo=datetime.UTC)
+    times = [day + datetime.timedelta(minutes=15 * m) for m in range(3)]
+    for t in times:
+        storage.save(WaterCompany.Anglian, t, f"a,b\n{t}\n")
+    storage.compact(WaterCompany.Anglian, day.date(), delete=True)
+
+    reader = s3_storage(client, bundle_reads='range')
+    assert reader.load(WaterCompany.Anglian, times[1]) == f"a,b\n{times[1]}\n"
+    assert reader.exists(WaterCompany.Anglian, times[2], '.csv.gz')
+    assert not reader.exists(WaterCompany.Anglian, times[2], '.parquet')
+
+
+def test_compact_merges_late_files_into_bundle():
+    client = FakeClient()
+    storage = s3_storage(client)
+    day = datetime.datetime(2025, 3, 4, tzinfo=datetime.UTC)
+    storage.save(WaterCompany.Anglian, day, "a,b\n1\n")
+    storage.compact(WaterCompany.Anglian, day.date(), delete=True)
+
+    late = day + datetime.timedelta(hours=1)
+    storage.save_blob(WaterCompany.Anglian, late, '.parquet', io.BytesIO(b"parquet"))
+    assert storage.compact(WaterCompany.Anglian, day.date(), delete=True) == 1
+
+    reader = s3_storage(client)
+    assert reader.load(WaterCompany.Anglian, day) == "a,b\n1\n"
+    assert reader.load_blob(WaterCompany.Anglian, late, '.parquet') == b"parquet"
+
+
+def test_suffixes_from_listing_and_bundle():
+    client = FakeClient()
+    storage = s3_storage(client)
+    day = datetime.datetime(2025, 3, 4, tzinfo=datetime.UTC)
+    storage.save_blob(WaterCompany.Anglian, day, '.csv.zst', io.BytesIO(b"zst"))
+    storage.save(WaterCompany.Anglian, day + datetime.timedelta(minutes=15), "a,b\n")
+
+    assert storage.suffixes(WaterCompany.Anglian, day) == {'.csv.zst'}
+    storage.compact(WaterCompany.Anglian, day.date(), delete=True)
+    assert s3_storage(client).suffixes(WaterCompany.Anglian, day + datetime.timedelta(minutes=15)) == {'.csv.gz'}
+    assert s3_storage(client).suffixes(WaterCompany.Anglian, day + datetime.timedelta(minutes=30)) is None
+
+
+def test_exists_reads_only_the_bundle_index():
+    client = FakeClient()
+    storage = s3_storage(client)
+    day = datetime.datetime(2025, 3, 4, tzinfo=datetime.UTC)
+    storage.save(WaterCompany.Anglian, day, "a,b\n1\n")
+    storage.compact(WaterCompany.Anglian, day.date(), delete=True)
+
+    client.calls.clear()
+    reader = s3_storage(client)
+    assert reader.exists(WaterCompany.Anglian, day, '.csv.gz')
+    assert not reader.exists(WaterCompany.Anglian, day, '.parquet')
+    assert [c for c in client.calls if c[0] == 'get'] == [('get', "Anglian/2025/03/04/bundle.bin", "bytes=0-65535")]
+
+    # once the whole bundle has been read, that's used
+    assert reader.load(WaterCompany.Anglian, day) == "a,b\n1\n"
+    client.calls.clear()
+    assert reader.exists(WaterCompany.Anglian, day, '.csv.gz')
+    assert not [c for c in client.calls if c[0] == 'get']
@@ -0,0 +1,82 @@
+import datetime
+import io
+
+from sqlitedict import SqliteDict
+
+from companies import WaterCompany
+from storage import SqlliteStorage
+
+when = datetime.datetime(2025, 1, 1, 12, 0, 0, tzinfo=datetime.UTC)
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.UTC)
+
+
+def test_available_from_catalogue(tmp_path):
+    storage = SqlliteStorage(delegate=None, filename=str(tmp_path / "cache.sqlite"))
+    for hours in [0, 1, 2]:
+        storage.save(WaterCompany.Anglian, when + datetime.timedelta(hours=hours), "a,b\n1,2\n")
+    storage.save(WaterCompany.ThamesWater, when, "a,b\n1,2\n")
+
+    assert list(storage.available(WaterCompany.Anglian, since=when)) == [
+        when + datetime.timedelta(hours=1),
+        when + datetime.timedelta(hours=2),
+    ]
+    assert list(storage.available(WaterCompany.ThamesWater, since=when - datetime.timedelta(seconds=1))) == [when]
+    assert storage.load(WaterCompany.Anglian, when) == "a,b\n1,2\n"
+
+
+def test_catalogue_backfilled_from_existing_cache(tmp_path):
+    filename = str(tmp_path / "cache.sqlite")
+    with SqliteDict(filename=filename, autocommit=True) as cache:
+        cache["Anglian/20250101120000.csv.gz"] = b""
+        cache["Anglian/20250101130000.csv.gz"] = b""
+        cache["Anglian/20250101130000.parquet"] = b""
+
+    storage = SqlliteStorage(delegate=None, filename=filename)
+
+    assert list(storage.available(WaterCompany.Anglian, since=when - datetime.timedelta(hours=1))) == [
+        when,
+        when + datetime.timedelta(hours=1),
+    ]
+
+
+def test_evicts_least_recently_used(tmp_path):
+    storage = SqlliteStorage(delegate=None, filename=str(tmp_path / "cache.sqlite"), max_bytes=2500, commit_every=1)
+    times = [when + datetime.timedelta(minutes=15 * n) for n in range(3)]
+    for t in times[:2]:
+        storage.save_blob(WaterCompany.Anglian, t, '.parquet', io.BytesIO(b'x' * 1000))
+    assert storage.load_blob(WaterCompany.Anglian, times[0], '.parquet') is not None
+
+    storage.save_blob(WaterCompany.Anglian, times[2], '.parquet', io.BytesIO(b'x' * 1000))
+
+    assert storage.load_blob(WaterCompany.Anglian, times[1], '.parquet') is None
+    assert list(storage.available(WaterCompany.Anglian, since=when - datetime.timedelta(hours=1))) == [
+        times[0], times[2]
+    ]
+    stats = storage.stats()
+    assert stats['bytes'] == 2000
+    assert stats['evictions'] == 1
+    assert stats['hits'] == 1 and stats['misses'] == 1
+
+
+def test_uncommitted_until_batch_is_full(tmp_path):
+    filename = str(tmp_path / "cache.sqlite")
+    storage = SqlliteStorage(delegate=None, filename=filename, commit_every=3)
+    storage.save(WaterCompany.Anglian, when, "a,b\n1,2\n")
+
+    assert list(SqlliteStorage(delegate=None, filename=filename).available(WaterCompany.Anglian, since=EPOCH)) == []
+    storage.commit()
+    assert list(SqlliteStorage(delegate=None, filename=filename).available(WaterCompany.Anglian, since=EPOCH)) == [when]
+
+
+def test_suffixes_from_cache_or_delegate(tmp_path):
+    behind = SqlliteStorage(delegate=None, filename=str(tmp_path / "behind.sqlite"))
+    behind.save_blob(WaterCompany.Anglian, when, '.csv.zst', io.BytesIO(b"zst"))
+    behind.save_blob(WaterCompany.Anglian, when, '.parquet', io.BytesIO(b"parquet"))
+    storage = SqlliteStorage(delegate=behind, filename=str(tmp_path / "cache.sqlite"))
+
+    # a parquet copy alone doesn't say how the snapshot was saved, so that's asked of the delegate
+    storage.load_blob(WaterCompany.Anglian, when, '.parquet')
+    assert storage.suffixes(WaterCompany.Anglian, when) == {'.csv.zst', '.parquet'}
+
+    storage.save(WaterCompany.ThamesWater, when, "a,b\n1,2\n")
+    assert storage.suffixes(WaterCompany.ThamesWater, when) == {'.csv.gz'}
@@ -467,10 +467,9 @@ select * from daily_cso where stream_company = ? order by date
             query(
                 sql = """
 select file_time, status, statusstart, latesteventstart, latesteventend, lastupdated
-    from stream_files sf
-    join stream_file_events sfc on sf.stream_file_id = sfc.stream_file_id
+    from stream_file_events sfc
     where sfc.id = ?
-        and sf.file_time >= ? and sf.file_time < ?
+        and sfc.file_time >= ? and sfc.file_time < ?
         order by file_time desc
         ;
                 """.trimMargin(),